@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Small-get latency benchmark comparing memcached transports.
+
+usage: mc_bench.py [-n count] [-s size] address...
+
+Each address is host:port for TCP or a path for a unix domain socket.
+
+Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
+"""
+
+import sys
+import time
+import getopt
+
+from mc_bin_client import MemcachedClient, parseAddress
+
+def percentile(sortedVals, p):
+    return sortedVals[min(len(sortedVals) - 1, int(len(sortedVals) * p))]
+
+def bench(addr, count, size):
+    """Time count gets of a size byte value.
+
+    Returns (ops/s, p50 latency, p99 latency, client cpu per op) with
+    times in microseconds."""
+    host, port = parseAddress(addr)
+    mc = MemcachedClient(host, port)
+    mc.set('bench', 0, 0, 'x' * size)
+    # Warm up
+    for i in xrange(min(count, 1000)):
+        mc.get('bench')
+    latencies = []
+    cpuStart = time.clock()
+    start = time.time()
+    for i in xrange(count):
+        t = time.time()
+        mc.get('bench')
+        latencies.append(time.time() - t)
+    elapsed = time.time() - start
+    cpu = time.clock() - cpuStart
+    mc.close()
+    latencies.sort()
+    return (count / elapsed, percentile(latencies, 0.5) * 1e6,
+            percentile(latencies, 0.99) * 1e6, cpu / count * 1e6)
+
+if __name__ == '__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'n:s:')
+    opts = dict(opts)
+    count = int(opts.get('-n', 10000))
+    size = int(opts.get('-s', 32))
+    if not args:
+        print __doc__
+        sys.exit(1)
+    print "%-30s %10s %10s %10s %12s" % ('address', 'ops/s', 'p50 us',
+                                          'p99 us', 'cpu us/op')
+    for addr in args:
+        print "%-30s %10.0f %10.1f %10.1f %12.1f" % (
+            (addr,) + bench(addr, count, size))
@@ -5,18 +5,37 @@ Binary memcached test client.
 Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
 """
 
+import os
 import sys
 import time
 import hmac
+import mmap
 import socket
 import random
-import struct
 import exceptions
+import collections
 
 from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE
-from memcacheConstants import REQ_PKT_FMT, RES_PKT_FMT, MIN_RECV_PACKET
+from memcacheConstants import MIN_RECV_PACKET
 from memcacheConstants import SET_PKT_FMT, DEL_PKT_FMT, INCRDECR_RES_FMT
 import memcacheConstants
+import memcacheCodec
+import memcacheHotKeys
+import memcacheCapture
+
+SET_PKT=memcacheCodec.getStruct(SET_PKT_FMT)
+GET_RES=memcacheCodec.getStruct(memcacheConstants.GET_RES_FMT)
+INCRDECR_PKT=memcacheCodec.getStruct(memcacheConstants.INCRDECR_PKT_FMT)
+INCRDECR_RES=memcacheCodec.getStruct(INCRDECR_RES_FMT)
+FLUSH_PKT=memcacheCodec.getStruct(memcacheConstants.FLUSH_PKT_FMT)
+DELETE_PREFIX_PKT=memcacheCodec.getStruct(
+    memcacheConstants.DELETE_PREFIX_PKT_FMT)
+DELETE_PREFIX_RES=memcacheCodec.getStruct(
+    memcacheConstants.DELETE_PREFIX_RES_FMT)
+
+# Targets get_into fills from the start rather than writes to like files
+# (an mmap has a write method too, but it writes at its current position).
+BUFFER_TYPES=(bytearray, mmap.mmap)
 
 class MemcachedError(exceptions.Exception):
     """Error raised when a command fails."""
@@ -32,15 +51,154 @@ class MemcachedError(exceptions.Exception):
     def __repr__(self):
         return "<MemcachedError #%d ``%s''>" % (self.status, self.msg)
 
+def parseAddress(addr):
+    """Split a host:port address into (host, port).  Paths (unix domain
+    sockets) come back as (path, None)."""
+    if addr.startswith('/'):
+        return addr, None
+    host, port=addr.rsplit(':', 1)
+    return host, int(port)
+
+class CounterAggregator(object):
+    """Collects counter deltas locally and applies them in batches.
+
+    Pending deltas are sent through client.incr_multi once maxKeys
+    counters are pending, or once interval seconds have passed since the
+    last flush.  There's no timer: the interval is only checked by incr,
+    decr and flush_if_due, so something should call flush_if_due now
+    and then (or flush at the end) to not leave the last batch waiting
+    for more traffic.  Counters that don't exist yet start from init and
+    get exp.
+
+    If a flush fails, its deltas go back to pending to be sent by the
+    next flush (the server may have applied some of them already, which
+    would then be counted twice).
+
+    Net deltas are applied, so a counter that would have hit zero
+    part-way through a batch of decrements isn't clamped there."""
+
+    def __init__(self, client, interval=1.0, maxKeys=1000, init=0, exp=0,
+                 quiet=False, onFlush=None, clock=time.time):
+        """onFlush, if given, is called with the results of every flush
+        (see MemcachedClient.incr_multi)."""
+        self.client=client
+        self.interval=interval
+        self.maxKeys=maxKeys
+        self.init=init
+        self.exp=exp
+        self.quiet=quiet
+        self.onFlush=onFlush
+        self.clock=clock
+        self.pending={}
+        self.lastFlush=clock()
+
+    def incr(self, key, amt=1):
+        self.pending[key]=self.pending.get(key, 0) + amt
+        if len(self.pending) >= self.maxKeys:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def decr(self, key, amt=1):
+        self.incr(key, -amt)
+
+    def flush_if_due(self):
+        """Flush if interval seconds have passed since the last flush.
+
+        Returns the results of the flush, or None if it wasn't due."""
+        if self.pending and self.clock() - self.lastFlush >= self.interval:
+            return self.flush()
+
+    def flush(self):
+        """Apply every pending delta now and return the results."""
+        deltas=self.pending
+        self.pending={}
+        self.lastFlush=self.clock()
+        try:
+            rv=self.client.incr_multi(deltas, self.init, self.exp,
+                                      self.quiet)
+        except:
+            for k, v in deltas.iteritems():
+                self.pending[k]=self.pending.get(k, 0) + v
+            raise
+        if self.onFlush:
+            self.onFlush(rv)
+        return rv
+
+class NegativeCache(object):
+    """Remembers keys recently found missing for up to ttl seconds.
+
+    At most size keys are kept; the oldest misses are forgotten first."""
+
+    def __init__(self, ttl=1.0, size=10000, clock=time.time):
+        self.ttl=ttl
+        self.size=size
+        self.clock=clock
+        # key -> time the miss stops being trusted, oldest first
+        self.misses=collections.OrderedDict()
+
+    def __contains__(self, key):
+        expires=self.misses.get(key)
+        if expires is None:
+            return False
+        if self.clock() >= expires:
+            del self.misses[key]
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.misses)
+
+    def add(self, key):
+        self.misses.pop(key, None)
+        self.misses[key]=self.clock() + self.ttl
+        while len(self.misses) > self.size:
+            self.misses.popitem(last=False)
+
+    def discard(self, key):
+        self.misses.pop(key, None)
+
+    def clear(self):
+        self.misses.clear()
+
 class MemcachedClient(object):
     """Simple memcached client."""
 
     vbucketId = 0
 
-    def __init__(self, host='127.0.0.1', port=11211):
-        self.s=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.s.connect_ex((host, port))
+    # Datatype used to compress large values (None disables compression)
+    compression = None
+    # Values shorter than this are sent as they are
+    compressThreshold = 1024
+
+    # Size of the pieces streamed values are sent and received in
+    CHUNK_SIZE = 65536
+
+    # Tracker of the keys this client reads most (None when not tracking)
+    hotKeys = None
+
+    # Where traffic is being recorded (None when not capturing)
+    capture = None
+
+    # Recent misses answered without asking the server (None when off)
+    negativeCache = None
+
+    def __init__(self, host='127.0.0.1', port=11211, timeout=None):
+        """Connect to host:port, or to the unix domain socket at host when
+        it's a path.
+
+        With a timeout (in seconds), connecting and each socket operation
+        raise socket.timeout rather than blocking for longer."""
+        if host.startswith('/'):
+            self.s=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            addr=host
+        else:
+            self.s=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            addr=(host, port)
+        self.s.settimeout(timeout)
+        self.s.connect(addr)
         self.r=random.Random()
+        self.hdrbuf=bytearray(MIN_RECV_PACKET)
 
     def close(self):
         self.s.close()
@@ -48,54 +206,86 @@ class MemcachedClient(object):
     def __del__(self):
         self.close()
 
-    def _sendCmd(self, cmd, key, val, opaque, extraHeader='', cas=0):
-        dtype=0
-        msg=struct.pack(REQ_PKT_FMT, REQ_MAGIC_BYTE,
-            cmd, len(key), len(extraHeader), dtype, self.vbucketId,
-                len(key) + len(extraHeader) + len(val), opaque, cas)
-        self.s.send(msg + extraHeader + key + val)
-
-    def _handleKeyedResponse(self, myopaque):
-        response = ""
-        while len(response) < MIN_RECV_PACKET:
-            data = self.s.recv(MIN_RECV_PACKET - len(response))
-            if data == '':
+    def _sendCmd(self, cmd, key, val, opaque, extraHeader='', cas=0, dtype=0):
+        msg=memcacheCodec.encodeRequest(cmd, key, val, opaque, extraHeader,
+            cas, self.vbucketId, dtype)
+        if self.capture:
+            self.capture.write(memcacheCapture.DIR_REQUEST, self.captureId,
+                               msg)
+        self.s.sendall(msg)
+
+    def _recvInto(self, buf):
+        """Fill the given buffer from the socket."""
+        view=memoryview(buf)
+        got=0
+        while got < len(buf):
+            n=self.s.recv_into(view[got:])
+            if n == 0:
                 raise exceptions.EOFError("Got empty data (remote died?).")
-            response += data
-        assert len(response) == MIN_RECV_PACKET
-        magic, cmd, keylen, extralen, dtype, errcode, remaining, opaque, cas=\
-            struct.unpack(RES_PKT_FMT, response)
+            got += n
 
+    def _recvBody(self, remaining):
         rv = ""
-        while remaining > 0:
-            data = self.s.recv(remaining)
-            if data == '':
-                raise exceptions.EOFError("Got empty data (remote died?).")
-            rv += data
-            remaining -= len(data)
+        if remaining > 0:
+            body=bytearray(remaining)
+            self._recvInto(body)
+            rv=str(body)
+        return rv
+
+    def _readHeader(self, myopaque):
+        """Read a response header.
 
+        Returns (magic, cmd, keylen, extralen, dtype, errcode, bodylen,
+        opaque, cas)"""
+        self._recvInto(self.hdrbuf)
+        hdr=memcacheCodec.RES_HDR.unpack_from(self.hdrbuf)
+        magic, opaque=hdr[0], hdr[7]
         assert (magic in (RES_MAGIC_BYTE, REQ_MAGIC_BYTE)), "Got magic: %d" % magic
         assert myopaque is None or opaque == myopaque, \
             "expected opaque %x, got %x" % (myopaque, opaque)
+        return hdr
+
+    def _handleKeyedResponse(self, myopaque):
+        magic, cmd, keylen, extralen, dtype, errcode, remaining, opaque, cas=\
+            self._readHeader(myopaque)
+        rv=self._recvBody(remaining)
+        if self.capture:
+            self.capture.write(memcacheCapture.DIR_RESPONSE, self.captureId,
+                               str(self.hdrbuf) + rv)
         if errcode != 0:
             raise MemcachedError(errcode,  rv)
+        if memcacheCodec.isCompressed(dtype):
+            hlen=keylen + extralen
+            rv=rv[:hlen] + memcacheCodec.decompress(dtype, rv[hlen:])
         return cmd, opaque, cas, keylen, extralen, rv
 
     def _handleSingleResponse(self, myopaque):
         cmd, opaque, cas, keylen, extralen, data = self._handleKeyedResponse(myopaque)
         return opaque, cas, data
 
-    def _doCmd(self, cmd, key, val, extraHeader='', cas=0):
+    def _doCmd(self, cmd, key, val, extraHeader='', cas=0, dtype=0):
         """Send a command and await its response."""
         opaque=self.r.randint(0, 2**32)
-        self._sendCmd(cmd, key, val, opaque, extraHeader, cas)
+        self._sendCmd(cmd, key, val, opaque, extraHeader, cas, dtype)
         return self._handleSingleResponse(opaque)
 
+    def _compress(self, val):
+        """Compress the value if it's worth it.
+
+        Returns (dtype, val)"""
+        if self.compression is not None and len(val) >= self.compressThreshold:
+            compressed=memcacheCodec.compress(self.compression, val)
+            if len(compressed) < len(val):
+                return self.compression, compressed
+        return memcacheConstants.DATATYPE_RAW, val
+
     def _mutate(self, cmd, key, exp, flags, cas, val):
-        return self._doCmd(cmd, key, val, struct.pack(SET_PKT_FMT, flags, exp),
-            cas)
+        self._noteWrite(key)
+        dtype, val=self._compress(val)
+        return self._doCmd(cmd, key, val, SET_PKT.pack(flags, exp), cas, dtype)
 
     def _cat(self, cmd, key, cas, val):
+        self._noteWrite(key)
         return self._doCmd(cmd, key, val, '', cas)
 
     def append(self, key, value, cas=0):
@@ -105,9 +295,10 @@ class MemcachedClient(object):
         return self._cat(memcacheConstants.CMD_PREPEND, key, cas, value)
 
     def __incrdecr(self, cmd, key, amt, init, exp):
+        self._noteWrite(key)
         something, cas, val=self._doCmd(cmd, key, '',
-            struct.pack(memcacheConstants.INCRDECR_PKT_FMT, amt, init, exp))
-        return struct.unpack(INCRDECR_RES_FMT, val)[0], cas
+            INCRDECR_PKT.pack(amt, init, exp))
+        return INCRDECR_RES.unpack(val)[0], cas
 
     def incr(self, key, amt=1, init=0, exp=0):
         """Increment or create the named counter."""
@@ -130,14 +321,151 @@ class MemcachedClient(object):
         return self._mutate(memcacheConstants.CMD_REPLACE, key, exp, flags, 0,
             val)
 
-    def __parseGet(self, data):
-        flags=struct.unpack(memcacheConstants.GET_RES_FMT, data[-1][:4])[0]
+    def _parseGet(self, data):
+        flags=GET_RES.unpack_from(data[-1])[0]
         return flags, data[1], data[-1][4:]
 
+    def _parseGetk(self, cas, keylen, extralen, data):
+        """Split a GETK response body into (key, (flags, cas, value))."""
+        flags=GET_RES.unpack_from(data)[0]
+        return data[extralen:extralen + keylen], \
+            (flags, cas, data[extralen + keylen:])
+
+    def track_hot_keys(self, k=10, sampleRate=1.0, window=60):
+        """Start tracking the keys read most by this client."""
+        self.hotKeys=memcacheHotKeys.HotKeyTracker(k, sampleRate, window)
+
+    def hot_keys(self, n=None):
+        """The hottest keys read by this client as (key, count, rate)
+        tuples, e.g. to decide what's worth a near cache."""
+        if self.hotKeys is None:
+            return []
+        return self.hotKeys.hottest(n)
+
+    def _noteRead(self, key):
+        if self.hotKeys is not None:
+            self.hotKeys.record(key)
+
+    def enable_negative_cache(self, ttl=1.0, size=10000, clock=time.time):
+        """Remember misses for ttl seconds and answer gets for those keys
+        with ERR_NOT_FOUND without asking the server.
+
+        This client's own writes forget the key, but a key stored by
+        someone else keeps missing here until its entry expires."""
+        self.negativeCache=NegativeCache(ttl, size, clock)
+
+    def disable_negative_cache(self):
+        self.negativeCache=None
+
+    def _noteWrite(self, key):
+        if self.negativeCache is not None:
+            self.negativeCache.discard(key)
+
+    def _checkMiss(self, key):
+        if self.negativeCache is not None and key in self.negativeCache:
+            raise MemcachedError(memcacheConstants.ERR_NOT_FOUND, 'Not found')
+
+    def _noteMiss(self, key, e):
+        if self.negativeCache is not None \
+                and e.status == memcacheConstants.ERR_NOT_FOUND:
+            self.negativeCache.add(key)
+
     def get(self, key):
         """Get the value for a given key within the memcached server."""
-        parts=self._doCmd(memcacheConstants.CMD_GET, key, '')
-        return self.__parseGet(parts)
+        self._noteRead(key)
+        self._checkMiss(key)
+        try:
+            parts=self._doCmd(memcacheConstants.CMD_GET, key, '')
+        except MemcachedError, e:
+            self._noteMiss(key, e)
+            raise
+        return self._parseGet(parts)
+
+    def set_from(self, key, exp, flags, fileobj, length, cas=0):
+        """Set a value of the given length read from a file object.
+
+        The value is sent in CHUNK_SIZE pieces as it's read rather than
+        being loaded in memory.  If the file ends early the connection is
+        left mid-packet and should be closed."""
+        self._noteWrite(key)
+        extra=SET_PKT.pack(flags, exp)
+        opaque=self.r.randint(0, 2**32)
+        self.s.sendall(memcacheCodec.REQ_HDR.pack(REQ_MAGIC_BYTE,
+            memcacheConstants.CMD_SET, len(key), len(extra), 0, self.vbucketId,
+            len(key) + len(extra) + length, opaque, cas) + extra + key)
+        remaining=length
+        while remaining > 0:
+            chunk=fileobj.read(min(self.CHUNK_SIZE, remaining))
+            if not chunk:
+                raise exceptions.EOFError("Value source ended %d bytes short."
+                                          % remaining)
+            self.s.sendall(chunk)
+            remaining -= len(chunk)
+        return self._handleSingleResponse(opaque)
+
+    def _streamInto(self, target, length):
+        """Receive length bytes into the start of a buffer (see
+        BUFFER_TYPES) or into a file (anything with write)."""
+        if not isinstance(target, BUFFER_TYPES):
+            chunk=bytearray(min(self.CHUNK_SIZE, length))
+            view=memoryview(chunk)
+            while length > 0:
+                n=self.s.recv_into(view, min(len(chunk), length))
+                if n == 0:
+                    raise exceptions.EOFError("Got empty data (remote died?).")
+                target.write(view[:n].tobytes())
+                length -= n
+            return
+        try:
+            self._recvInto(memoryview(target)[:length])
+        except TypeError:
+            # An mmap only supports slice assignment here.
+            chunk=bytearray(min(self.CHUNK_SIZE, length))
+            offset=0
+            while offset < length:
+                n=self.s.recv_into(chunk, min(len(chunk), length - offset))
+                if n == 0:
+                    raise exceptions.EOFError("Got empty data (remote died?).")
+                target[offset:offset + n]=str(chunk[:n])
+                offset += n
+
+    def get_into(self, key, target):
+        """Get a value directly into a file object or into the start of a
+        caller-provided buffer (bytearray, mmap) large enough to hold it.
+
+        Returns (flags, cas, length)"""
+        self._noteRead(key)
+        self._checkMiss(key)
+        opaque=self.r.randint(0, 2**32)
+        self._sendCmd(memcacheConstants.CMD_GET, key, '', opaque)
+        magic, cmd, keylen, extralen, dtype, errcode, remaining, opaque, cas=\
+            self._readHeader(opaque)
+        if errcode != 0:
+            e=MemcachedError(errcode, self._recvBody(remaining))
+            self._noteMiss(key, e)
+            raise e
+        if memcacheCodec.isCompressed(dtype):
+            body=self._recvBody(remaining)
+            value=memcacheCodec.decompress(dtype, body[extralen+keylen:])
+            flags=GET_RES.unpack_from(body)[0]
+            if not isinstance(target, BUFFER_TYPES):
+                target.write(value)
+            elif len(target) < len(value):
+                raise ValueError("Buffer of %d bytes is too small for %d"
+                                 % (len(target), len(value)))
+            else:
+                target[:len(value)]=value
+            return flags, cas, len(value)
+        prefix=self._recvBody(extralen + keylen)
+        flags=GET_RES.unpack_from(prefix)[0]
+        length=remaining - len(prefix)
+        if isinstance(target, BUFFER_TYPES) and len(target) < length:
+            # Keep the connection usable before complaining.
+            self._streamInto(open(os.devnull, 'wb'), length)
+            raise ValueError("Buffer of %d bytes is too small for %d"
+                             % (len(target), length))
+        self._streamInto(target, length)
+        return flags, cas, length
 
     def cas(self, key, exp, flags, oldVal, val):
         """CAS in a new value for the given key and comparison value."""
@@ -174,6 +502,28 @@ class MemcachedClient(object):
         return self._doCmd(memcacheConstants.CMD_SASL_STEP, 'CRAM-MD5',
                            user + ' ' + dig)
 
+    def enable_compression(self, codec='zlib', threshold=1024):
+        """Compress values of at least threshold bytes with the named codec.
+
+        Pass None as the codec to turn compression off."""
+        if codec is None:
+            self.compression=None
+            return
+        dtype=memcacheCodec.CODECS.get(codec)
+        if not memcacheCodec.isCompressed(dtype):
+            raise ValueError("Compression codec %s is not available" % codec)
+        self.compression=dtype
+        self.compressThreshold=threshold
+
+    def start_capture(self, capture):
+        """Record the requests and responses of this connection with a
+        memcacheCapture.CaptureWriter (streamed values aren't recorded)."""
+        self.capture=capture
+        self.captureId=capture.newConnection()
+
+    def stop_capture(self):
+        self.capture=None
+
     def set_vbucket_state(self, vbucket, state):
         return self._doCmd(memcacheConstants.CMD_SET_VBUCKET_STATE,
                            str(vbucket), state)
@@ -181,28 +531,77 @@ class MemcachedClient(object):
     def delete_vbucket(self, vbucket):
         return self._doCmd(memcacheConstants.CMD_DELETE_VBUCKET, str(vbucket), '')
 
+    def incr_multi(self, deltas, init=0, exp=0, quiet=False):
+        """Apply a dict of counter deltas (negative ones decrement) in one
+        pipelined batch.
+
+        Counters that don't exist yet are created as init plus their delta
+        (floored at zero).  Returns a dict of key to (value, cas), or to the
+        MemcachedError the key failed with.  With quiet, successes aren't
+        answered by the server and map to None.
+
+        Each batch uses its own range of opaques, so responses left over
+        from an earlier batch that failed part-way are skipped."""
+        keys=[k for k, v in deltas.iteritems() if v]
+        base=self.r.randint(0, 2**32 - len(keys) - 1)
+        terminal=base + len(keys)
+        for i, k in enumerate(keys):
+            self._noteWrite(k)
+            delta=deltas[k]
+            if delta > 0:
+                cmd=quiet and memcacheConstants.CMD_INCRQ \
+                    or memcacheConstants.CMD_INCR
+            else:
+                cmd=quiet and memcacheConstants.CMD_DECRQ \
+                    or memcacheConstants.CMD_DECR
+            self._sendCmd(cmd, k, '', base + i,
+                INCRDECR_PKT.pack(abs(delta), max(0, init + delta), exp))
+        self._sendCmd(memcacheConstants.CMD_NOOP, '', '', terminal)
+
+        rv=dict.fromkeys(keys)
+        while True:
+            magic, cmd, keylen, extralen, dtype, errcode, remaining, opaque, \
+                cas=self._readHeader(None)
+            data=self._recvBody(remaining)
+            if opaque == terminal and cmd == memcacheConstants.CMD_NOOP:
+                return rv
+            if not base <= opaque < terminal:
+                continue
+            if errcode:
+                rv[keys[opaque - base]]=MemcachedError(errcode, data)
+            else:
+                rv[keys[opaque - base]]=(INCRDECR_RES.unpack(data)[0], cas)
+
     def getMulti(self, keys):
         """Get values for any available keys in the given iterable.
 
-        Returns a dict of matched keys to their values."""
-        opaqued=dict(enumerate(keys))
-        terminal=len(opaqued)+10
-        # Send all of the keys in quiet
-        for k,v in opaqued.iteritems():
-            self._sendCmd(memcacheConstants.CMD_GETQ, v, '', k)
-
-        self._sendCmd(memcacheConstants.CMD_NOOP, '', '', terminal)
+        Returns a dict of matched keys to their values.  Keys in the
+        negative cache aren't asked for, and each key is only asked for
+        once."""
+        keys=list(collections.OrderedDict.fromkeys(keys))
+        for k in keys:
+            self._noteRead(k)
+        if self.negativeCache is not None:
+            keys=[k for k in keys if k not in self.negativeCache]
+        # Hits carry their key, so one opaque does for the whole batch.
+        opaque=self.r.randint(0, 2**32)
+        for k in keys:
+            self._sendCmd(memcacheConstants.CMD_GETKQ, k, '', opaque)
+        self._sendCmd(memcacheConstants.CMD_NOOP, '', '', opaque)
 
-        # Handle the response
         rv={}
-        done=False
-        while not done:
-            opaque, cas, data=self._handleSingleResponse(None)
-            if opaque != terminal:
-                rv[opaqued[opaque]]=self.__parseGet((opaque, cas, data))
-            else:
-                done=True
-
+        while True:
+            cmd, opaque, cas, keylen, extralen, data=\
+                self._handleKeyedResponse(opaque)
+            if cmd == memcacheConstants.CMD_NOOP:
+                break
+            key, val=self._parseGetk(cas, keylen, extralen, data)
+            rv[key]=val
+
+        if self.negativeCache is not None:
+            for k in keys:
+                if k not in rv:
+                    self.negativeCache.add(k)
         return rv
 
     def stats(self, sub=''):
@@ -225,9 +624,22 @@ class MemcachedClient(object):
 
     def delete(self, key, cas=0):
         """Delete the value for a given key within the memcached server."""
+        self._noteWrite(key)
         return self._doCmd(memcacheConstants.CMD_DELETE, key, '', '', cas)
 
+    def delete_prefix(self, prefix, countOnly=False):
+        """Delete every key starting with the given prefix.
+
+        With countOnly, nothing is deleted.  Returns the number of matching
+        keys."""
+        flags=0
+        if countOnly:
+            flags |= memcacheConstants.DELETE_PREFIX_COUNT_ONLY
+        something, cas, data=self._doCmd(memcacheConstants.CMD_DELETE_PREFIX,
+            prefix, '', DELETE_PREFIX_PKT.pack(flags))
+        return DELETE_PREFIX_RES.unpack(data)[0]
+
     def flush(self, timebomb=0):
         """Flush all storage in a memcached instance."""
         return self._doCmd(memcacheConstants.CMD_FLUSH, '', '',
-            struct.pack(memcacheConstants.FLUSH_PKT_FMT, timebomb))
+            FLUSH_PKT.pack(timebomb))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+Replay a memcached traffic capture against a server.
+
+usage: mc_replay.py [-s speed] capture address
+
+Every captured connection is replayed over its own connection, sending
+requests in their original order and with their original pipelining
+(nothing waits for responses).  speed scales the original timing: 1
+replays in real time, 10 ten times faster, 0 as fast as possible.  The
+address is host:port or a unix domain socket path.
+
+Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
+"""
+
+import sys
+import time
+import getopt
+import socket
+import threading
+import collections
+
+import memcacheConstants
+import memcacheCodec
+import memcacheCapture
+from mc_bin_client import parseAddress
+
+# Opaque of the noop sent after the last request of each connection
+SENTINEL = 0xffffffff
+
+def loadCapture(f):
+    """Group a capture by connection.
+
+    Returns {conn: (requests, responses)}, where requests are (timestamp,
+    packet) and responses are packets, both in their original order."""
+    rv = {}
+    for direction, when, conn, packet in memcacheCapture.readCapture(f):
+        requests, responses = rv.setdefault(conn, ([], []))
+        if direction == memcacheCapture.DIR_REQUEST:
+            requests.append((when, packet))
+        else:
+            responses.append(packet)
+    return rv
+
+def comparable(packet):
+    """The parts of a response expected to be the same on a replay (the
+    CAS differs from server to server)."""
+    pkt = memcacheCodec.PacketView(packet)
+    return (pkt.opcode, pkt.status, pkt.keylen, pkt.extralen, pkt.datatype,
+            pkt.opaque, pkt.body.tobytes())
+
+class Connection(object):
+    """Replays one captured connection."""
+
+    def __init__(self, addr, requests, expected):
+        host, port = parseAddress(addr)
+        if port is None:
+            self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.s.connect(host)
+        else:
+            self.s = socket.create_connection((host, port))
+            self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.requests = requests
+        self.expected = expected
+        # (opaque, opcode, send time) of requests not yet answered, in
+        # the order they were sent
+        self.outstanding = collections.deque()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.responses = []
+        self.error = None
+
+    def send(self, start, first, speed):
+        """Send every request at its (scaled) original time relative to
+        first, the time of the first request in the whole capture."""
+        try:
+            for when, packet in self.requests:
+                if speed:
+                    delay = start + (when - first) / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                pkt = memcacheCodec.PacketView(packet)
+                with self.lock:
+                    self.outstanding.append((pkt.opaque, pkt.opcode,
+                                             time.time()))
+                self.s.sendall(packet)
+            self.s.sendall(memcacheCodec.encodeRequest(
+                memcacheConstants.CMD_NOOP, opaque=SENTINEL))
+        except Exception, e:
+            self.error = e
+            # Wake up the receiver.
+            self.s.shutdown(socket.SHUT_RDWR)
+
+    def receive(self):
+        buf = bytearray()
+        try:
+            while True:
+                data = self.s.recv(65536)
+                if not data:
+                    raise EOFError("Server hung up")
+                buf.extend(data)
+                consumed = 0
+                for pkt in memcacheCodec.iterPackets(buf):
+                    consumed += pkt.size
+                    if pkt.opaque == SENTINEL \
+                            and pkt.opcode == memcacheConstants.CMD_NOOP:
+                        return
+                    sent = self.answered(pkt.opaque, pkt.opcode)
+                    if sent is not None:
+                        self.latencies.append(time.time() - sent)
+                    self.responses.append(pkt.raw.tobytes())
+                del buf[:consumed]
+        except Exception, e:
+            self.error = e
+
+    def answered(self, opaque, opcode):
+        """The send time of the request a response answers, or None when
+        it isn't the first response to one (e.g. further stats).
+
+        Responses come in request order, so requests sent before the one
+        answered got no response (quiet ones) and are dropped."""
+        with self.lock:
+            for i, (o, c, when) in enumerate(self.outstanding):
+                if o == opaque and c == opcode:
+                    for j in range(i + 1):
+                        self.outstanding.popleft()
+                    return when
+        return None
+
+    def mismatches(self):
+        """(index, expected, got) for every response that differs from the
+        capture."""
+        rv = []
+        for i in range(max(len(self.expected), len(self.responses))):
+            exp = got = None
+            if i < len(self.expected):
+                exp = comparable(self.expected[i])
+            if i < len(self.responses):
+                got = comparable(self.responses[i])
+            if exp != got:
+                rv.append((i, exp, got))
+        return rv
+
+def replay(connections, addr, speed=1.0):
+    """Replay connections as returned by loadCapture against addr.
+
+    Returns a dict of requests, elapsed, ops_per_sec, latency percentiles
+    (in seconds), errors and mismatches (conn -> list of mismatches)."""
+    conns = dict((c, Connection(addr, reqs, resps))
+                 for c, (reqs, resps) in connections.iteritems())
+    threads = []
+    first = min([reqs[0][0] for reqs, resps in connections.values() if reqs]
+                or [0])
+    start = time.time()
+    for c in conns.values():
+        for target, args in ((c.receive, ()), (c.send, (start, first, speed))):
+            t = threading.Thread(target=target, args=args)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    for c in conns.values():
+        c.s.close()
+
+    latencies = sorted(l for c in conns.values() for l in c.latencies)
+    def pct(p):
+        if not latencies:
+            return 0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+    requests = sum(len(c.requests) for c in conns.values())
+    mismatches = dict((k, c.mismatches()) for k, c in conns.iteritems())
+    return {'requests': requests,
+            'elapsed': elapsed,
+            'ops_per_sec': requests / elapsed if elapsed else 0,
+            'p50': pct(0.5), 'p99': pct(0.99), 'max': pct(1),
+            'errors': dict((k, c.error) for k, c in conns.iteritems()
+                           if c.error),
+            'mismatches': dict((k, m) for k, m in mismatches.iteritems()
+                               if m)}
+
+if __name__ == '__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 's:')
+    speed = float(dict(opts).get('-s', 1))
+    if len(args) != 2:
+        print __doc__
+        sys.exit(1)
+    rv = replay(loadCapture(open(args[0], 'rb')), args[1], speed)
+    print "%d requests in %.3fs (%.0f ops/s)" % (rv['requests'], rv['elapsed'],
+                                                 rv['ops_per_sec'])
+    print "latency p50 %.1fus p99 %.1fus max %.1fus" % (
+        rv['p50'] * 1e6, rv['p99'] * 1e6, rv['max'] * 1e6)
+    for conn, e in sorted(rv['errors'].items()):
+        print "connection %d failed: %s" % (conn, e)
+    for conn, mismatches in sorted(rv['mismatches'].items()):
+        print "connection %d: %d mismatched responses" % (conn,
+                                                         len(mismatches))
+        for i, exp, got in mismatches[:5]:
+            print "  #%d expected %r" % (i, exp)
+            print "  #%d got      %r" % (i, got)
+    sys.exit(1 if rv['errors'] or rv['mismatches'] else 0)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Replica-aware memcached client with deadlines, hedged reads and failover.
+
+Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
+"""
+
+import time
+import zlib
+import select
+import socket
+import collections
+import exceptions
+
+import memcacheConstants
+from mc_bin_client import MemcachedClient, MemcachedError, parseAddress
+
+class NodesUnavailable(exceptions.Exception):
+    """Raised when no replica answered a command in time."""
+
+class Node(object):
+    """A server, a lazily made connection to it and its health.
+
+    After failureThreshold consecutive failures the node is ejected for
+    retryInterval seconds, after which a noop probe decides whether it's
+    back."""
+
+    # How many recent read latencies are kept for estimating percentiles
+    LATENCY_SAMPLES = 1000
+    # New samples after which percentiles are worked out again
+    RESORT_SAMPLES = 50
+
+    def __init__(self, addr, failureThreshold=3, retryInterval=5.0,
+                 clock=time.time):
+        self.addr=addr
+        self.failureThreshold=failureThreshold
+        self.retryInterval=retryInterval
+        self.clock=clock
+        self.client=None
+        self.failures=0
+        self.ejectedUntil=None
+        self.latencies=collections.deque(maxlen=self.LATENCY_SAMPLES)
+        # Sorted copy of latencies and how many samples it's missing
+        self.sortedLatencies=None
+        self.newSamples=0
+
+    def connection(self, timeout):
+        """Get a connection whose socket operations time out after the
+        given number of seconds."""
+        if self.client is None:
+            host, port=parseAddress(self.addr)
+            self.client=MemcachedClient(host, port, timeout)
+        self.client.s.settimeout(timeout)
+        return self.client
+
+    def disconnect(self):
+        """Drop the connection, e.g. when a response will never be read."""
+        if self.client is not None:
+            self.client.close()
+            self.client=None
+
+    def available(self, timeout):
+        """Whether this node should be used, probing it if its ejection has
+        run out."""
+        if self.ejectedUntil is None:
+            return True
+        if self.clock() < self.ejectedUntil:
+            return False
+        try:
+            self.connection(timeout).noop()
+        except (socket.error, EOFError):
+            self.failed()
+            return False
+        self.succeeded()
+        return True
+
+    def succeeded(self, readLatency=None):
+        """Note an answer, and for reads how long it took (writes would
+        skew the hedging delay)."""
+        self.failures=0
+        self.ejectedUntil=None
+        if readLatency is not None:
+            self.latencies.append(readLatency)
+            self.newSamples += 1
+
+    def failed(self):
+        self.disconnect()
+        self.failures += 1
+        if self.ejectedUntil is not None \
+                or self.failures >= self.failureThreshold:
+            self.ejectedUntil=self.clock() + self.retryInterval
+
+    def percentile(self, p):
+        """The read latency at the given percentile (0-1), or None without
+        enough samples.
+
+        The samples are only sorted again every RESORT_SAMPLES reads."""
+        if len(self.latencies) < 20:
+            return None
+        if self.sortedLatencies is None \
+                or self.newSamples >= self.RESORT_SAMPLES:
+            self.sortedLatencies=sorted(self.latencies)
+            self.newSamples=0
+        vals=self.sortedLatencies
+        return vals[min(len(vals) - 1, int(len(vals) * p))]
+
+    def __repr__(self):
+        state='ejected' if self.ejectedUntil is not None else 'ok'
+        return "<Node %s %s failures=%d>" % (self.addr, state, self.failures)
+
+class ReplicatedClient(object):
+    """Client for a cluster where each key lives on `replicas` nodes.
+
+    Every command gets `timeout` seconds.  Writes go to every available
+    replica of the key.  A read that hasn't been answered within the
+    primary's hedgePercentile latency (or hedgeDelay until there's enough
+    history) is also sent to the next replica, and the first answer
+    wins."""
+
+    def __init__(self, addrs, replicas=2, timeout=1.0, hedgeDelay=0.05,
+                 hedgePercentile=0.95, failureThreshold=3, retryInterval=5.0,
+                 clock=time.time):
+        self.nodes=[Node(a, failureThreshold, retryInterval, clock)
+                    for a in addrs]
+        self.replicas=min(replicas, len(self.nodes))
+        self.timeout=timeout
+        self.hedgeDelay=hedgeDelay
+        self.hedgePercentile=hedgePercentile
+        self.clock=clock
+
+    def close(self):
+        for n in self.nodes:
+            n.disconnect()
+
+    def _replicas(self, key):
+        """The nodes holding the given key, primary first."""
+        first=(zlib.crc32(key) & 0xffffffff) % len(self.nodes)
+        return [self.nodes[(first + i) % len(self.nodes)]
+                for i in range(self.replicas)]
+
+    def _available(self, key, deadline):
+        return [n for n in self._replicas(key)
+                if n.available(max(deadline - self.clock(), 0.001))]
+
+    def _hedgeAfter(self, node):
+        rv=node.percentile(self.hedgePercentile)
+        return self.hedgeDelay if rv is None else rv
+
+    def _write(self, key, f):
+        """Apply f(client) on every available replica of key.
+
+        Returns the first node's result.  A MemcachedError is an answer
+        too and is raised if no node succeeded."""
+        deadline=self.clock() + self.timeout
+        results=[]
+        errors=[]
+        for node in self._available(key, deadline):
+            remaining=deadline - self.clock()
+            if remaining <= 0:
+                break
+            try:
+                results.append(f(node.connection(remaining)))
+                node.succeeded()
+            except MemcachedError, e:
+                node.succeeded()
+                errors.append(e)
+            except (socket.error, EOFError):
+                node.failed()
+        if results:
+            return results[0]
+        if errors:
+            raise errors[0]
+        raise NodesUnavailable("No replica of %s answered" % key)
+
+    def _read(self, key, cmd):
+        """Send a read to the key's primary, hedge it to further replicas
+        as needed and return the first answer."""
+        deadline=self.clock() + self.timeout
+        waiting=collections.deque(self._available(key, deadline))
+        # socket -> (node, opaque, start time) for requests in flight
+        inflight={}
+        try:
+            while True:
+                now=self.clock()
+                if now >= deadline:
+                    for node, opaque, start in inflight.values():
+                        node.failed()
+                    inflight.clear()
+                    raise NodesUnavailable("No replica of %s answered in %.3fs"
+                                           % (key, self.timeout))
+                if waiting and (not inflight or now >= hedgeAt):
+                    node=waiting.popleft()
+                    try:
+                        client=node.connection(deadline - now)
+                        opaque=client.r.randint(0, 2**32)
+                        client._sendCmd(cmd, key, '', opaque)
+                    except (socket.error, EOFError):
+                        node.failed()
+                        continue
+                    inflight[client.s]=(node, opaque, now)
+                    hedgeAt=now + self._hedgeAfter(node)
+                if not inflight:
+                    raise NodesUnavailable("No replica of %s available" % key)
+                wait=deadline - now
+                if waiting:
+                    wait=min(wait, max(hedgeAt - now, 0))
+                readable=select.select(inflight.keys(), [], [], wait)[0]
+                for s in readable:
+                    node, opaque, start=inflight.pop(s)
+                    try:
+                        s.settimeout(max(deadline - self.clock(), 0.001))
+                        rv=node.client._handleSingleResponse(opaque)
+                    except MemcachedError:
+                        node.succeeded(self.clock() - start)
+                        raise
+                    except (socket.error, EOFError):
+                        node.failed()
+                        continue
+                    node.succeeded(self.clock() - start)
+                    return node.client, rv
+        finally:
+            # Responses to the losing requests would never be read.
+            for node, opaque, start in inflight.values():
+                node.disconnect()
+
+    def get(self, key):
+        """Get (flags, cas, value) for the given key from the fastest
+        replica."""
+        client, rv=self._read(key, memcacheConstants.CMD_GET)
+        return client._parseGet(rv)
+
+    def set(self, key, exp, flags, val):
+        return self._write(key, lambda c: c.set(key, exp, flags, val))
+
+    def add(self, key, exp, flags, val):
+        return self._write(key, lambda c: c.add(key, exp, flags, val))
+
+    def replace(self, key, exp, flags, val):
+        return self._write(key, lambda c: c.replace(key, exp, flags, val))
+
+    def delete(self, key):
+        return self._write(key, lambda c: c.delete(key))
+
+    def incr(self, key, amt=1, init=0, exp=0):
+        """Increment the counter on every replica (which may drift apart
+        if some of them miss an update)."""
+        return self._write(key, lambda c: c.incr(key, amt, init, exp))
+
+    def decr(self, key, amt=1, init=0, exp=0):
+        return self._write(key, lambda c: c.decr(key, amt, init, exp))
+
+    def health(self):
+        """Map of node address to (ejected, consecutive failures)."""
+        return dict((n.addr, (n.ejectedUntil is not None, n.failures))
+                    for n in self.nodes)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Binary protocol traffic capture files.
+
+A capture starts with MAGIC, followed by one record per packet: a header
+of (direction, timestamp, connection id, packet length) and the packet
+itself exactly as it went over the wire.
+
+Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
+"""
+
+import time
+import struct
+import threading
+
+MAGIC = "MCCAPTURE\x01"
+
+# direction, timestamp, connection id, packet length
+RECORD = struct.Struct(">BdII")
+
+DIR_REQUEST = 0
+DIR_RESPONSE = 1
+
+class CaptureWriter(object):
+    """Writes timestamped packets for any number of connections to a file
+    object."""
+
+    def __init__(self, f, clock=time.time):
+        self.f = f
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.nextConn = 0
+        f.write(MAGIC)
+
+    def newConnection(self):
+        """Allocate an id for a connection being captured."""
+        with self.lock:
+            self.nextConn += 1
+            return self.nextConn
+
+    def write(self, direction, conn, packet):
+        rec = RECORD.pack(direction, self.clock(), conn, len(packet)) + packet
+        with self.lock:
+            self.f.write(rec)
+
+    def flush(self):
+        with self.lock:
+            self.f.flush()
+
+def readCapture(f):
+    """Iterate the (direction, timestamp, connection id, packet) records of
+    a capture."""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a memcached capture file")
+    while True:
+        hdr = f.read(RECORD.size)
+        if len(hdr) < RECORD.size:
+            return
+        direction, when, conn, length = RECORD.unpack(hdr)
+        packet = f.read(length)
+        if len(packet) < length:
+            return
+        yield direction, when, conn, packet
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+Binary protocol packet encoding and decoding shared by the client, the
+test server and the TAP paths.
+
+Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
+"""
+
+import zlib
+import struct
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
+from memcacheConstants import REQ_PKT_FMT, RES_PKT_FMT, MIN_RECV_PACKET
+from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE, EXTRA_HDR_FMTS
+from memcacheConstants import DATATYPE_ZLIB, DATATYPE_LZ4
+
+# Precompiled packet headers.
+REQ_HDR = struct.Struct(REQ_PKT_FMT)
+RES_HDR = struct.Struct(RES_PKT_FMT)
+
+_structs = {}
+
+def getStruct(fmt):
+    """Get the precompiled struct for the given format."""
+    try:
+        return _structs[fmt]
+    except KeyError:
+        s = _structs[fmt] = struct.Struct(fmt)
+        return s
+
+# Precompiled extras layouts by command.
+EXTRA_HDR_STRUCTS = dict((k, getStruct(v))
+                         for k, v in EXTRA_HDR_FMTS.iteritems())
+
+_NO_EXTRAS = getStruct('')
+
+def extraStruct(cmd):
+    """Get the precompiled extras layout for the given command."""
+    return EXTRA_HDR_STRUCTS.get(cmd, _NO_EXTRAS)
+
+def encodeRequest(cmd, key='', val='', opaque=0, extraHeader='', cas=0,
+                  vbucket=0, dtype=0):
+    """Encode a full request packet."""
+    return ''.join((REQ_HDR.pack(REQ_MAGIC_BYTE, cmd, len(key),
+                                 len(extraHeader), dtype, vbucket,
+                                 len(key) + len(extraHeader) + len(val),
+                                 opaque, cas),
+                    extraHeader, key, val))
+
+def encodeResponse(cmd, status, opaque, cas, body='', keylen=0, extralen=0,
+                   dtype=0):
+    """Encode a full response packet whose body has already been laid out
+    as extras, key, value."""
+    return RES_HDR.pack(RES_MAGIC_BYTE, cmd, keylen, extralen, dtype, status,
+                        len(body), opaque, cas) + body
+
+def packHeaderInto(buf, offset, magic, cmd, keylen, extralen, dtype,
+                   vbOrStatus, bodylen, opaque, cas):
+    """Write a packet header into a reusable buffer."""
+    REQ_HDR.pack_into(buf, offset, magic, cmd, keylen, extralen, dtype,
+                      vbOrStatus, bodylen, opaque, cas)
+
+def packetLength(buf, offset=0):
+    """Total length of the packet starting at offset, or None if the header
+    isn't complete yet."""
+    if len(buf) - offset < MIN_RECV_PACKET:
+        return None
+    return MIN_RECV_PACKET + REQ_HDR.unpack_from(buf, offset)[6]
+
+class PacketView(object):
+    """A view over a single packet within a buffer.
+
+    The header is decoded eagerly, the key and value are exposed as
+    memoryview slices into the original buffer and only copied when asked."""
+
+    __slots__ = ['buf', 'offset', 'magic', 'opcode', 'keylen', 'extralen',
+                 'datatype', 'status', 'bodylen', 'opaque', 'cas']
+
+    def __init__(self, buf, offset=0):
+        self.buf = buf
+        self.offset = offset
+        (self.magic, self.opcode, self.keylen, self.extralen, self.datatype,
+         self.status, self.bodylen, self.opaque, self.cas) = \
+            REQ_HDR.unpack_from(buf, offset)
+
+    @property
+    def vbucket(self):
+        """The vbucket of a request (shares its slot with status)."""
+        return self.status
+
+    @property
+    def size(self):
+        """Total size of this packet including the header."""
+        return MIN_RECV_PACKET + self.bodylen
+
+    def _slice(self, start, end):
+        base = self.offset + MIN_RECV_PACKET
+        return memoryview(self.buf)[base + start:base + end]
+
+    @property
+    def raw(self):
+        """The whole packet, header included."""
+        return memoryview(self.buf)[self.offset:self.offset + self.size]
+
+    @property
+    def body(self):
+        return self._slice(0, self.bodylen)
+
+    @property
+    def key(self):
+        return self._slice(self.extralen, self.extralen + self.keylen)
+
+    @property
+    def value(self):
+        return self._slice(self.extralen + self.keylen, self.bodylen)
+
+    def extraHeaders(self):
+        """Decode the extras according to this packet's command."""
+        s = extraStruct(self.opcode)
+        return s.unpack_from(self.buf, self.offset + MIN_RECV_PACKET)
+
+    def __repr__(self):
+        return "<PacketView magic=0x%x opcode=0x%x keylen=%d extralen=%d " \
+            "bodylen=%d opaque=0x%x>" % (self.magic, self.opcode, self.keylen,
+                                         self.extralen, self.bodylen,
+                                         self.opaque)
+
+def iterPackets(buf, offset=0):
+    """Yield a PacketView for every complete packet in buf from offset.
+
+    The caller can find how much was consumed by summing view sizes."""
+    while True:
+        n = packetLength(buf, offset)
+        if n is None or len(buf) - offset < n:
+            return
+        pkt = PacketView(buf, offset)
+        offset += n
+        yield pkt
+
+def splitKeys(cmd, keylen, data):
+    """Split a request body into (hdrTuple, key, data) according to the
+    extras layout of the given command."""
+    s = extraStruct(cmd)
+    hdrSize = s.size
+    assert hdrSize <= len(data), "Data too short for " + s.format + ': ' \
+        + `data`
+    assert len(data) >= hdrSize + keylen
+    hdr = s.unpack_from(data)
+    key = data[hdrSize:keylen+hdrSize]
+    assert len(key) == keylen, "len(%s) == %d, expected %d" \
+        % (key, len(key), keylen)
+    return hdr, key, data[keylen+hdrSize:]
+
+# Datatype -> (compress, decompress) for the codecs available here.
+COMPRESSORS = {DATATYPE_ZLIB: (zlib.compress, zlib.decompress)}
+if lz4:
+    COMPRESSORS[DATATYPE_LZ4] = (lz4.compress, lz4.decompress)
+
+# Codec names to datatypes.
+CODECS = {'zlib': DATATYPE_ZLIB, 'lz4': DATATYPE_LZ4}
+
+def isCompressed(dtype):
+    """True if the given datatype marks a compressed value."""
+    return dtype in COMPRESSORS
+
+def compress(dtype, data):
+    """Compress data with the codec for the given datatype."""
+    return COMPRESSORS[dtype][0](data)
+
+def decompress(dtype, data):
+    """Decompress data marked with the given datatype."""
+    return COMPRESSORS[dtype][1](data)
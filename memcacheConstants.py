@@ -19,9 +19,13 @@ CMD_FLUSH = 8
 CMD_GETQ = 9
 CMD_NOOP = 10
 CMD_VERSION = 11
+CMD_GETK = 0x0c
+CMD_GETKQ = 0x0d
 CMD_STAT = 0x10
 CMD_APPEND = 0x0e
 CMD_PREPEND = 0x0f
+CMD_INCRQ = 0x15
+CMD_DECRQ = 0x16
 
 # SASL stuff
 CMD_SASL_LIST_MECHS = 0x20
@@ -36,6 +40,9 @@ CMD_TAP_FLUSH = 0x43
 CMD_TAP_OPAQUE = 0x44
 CMD_TAP_VBUCKET_SET = 0x45
 
+# Bulk removal
+CMD_DELETE_PREFIX = 0x60
+
 # vbucket stuff
 CMD_SET_VBUCKET_STATE = 0x83
 CMD_GET_VBUCKET_STATE = 0x84
@@ -74,6 +81,19 @@ INCRDECR_RES_FMT=">Q"
 # Time bomb
 FLUSH_PKT_FMT=">I"
 
+# delete prefix flags; number of matching keys
+DELETE_PREFIX_PKT_FMT=">I"
+DELETE_PREFIX_RES_FMT=">Q"
+# Only count the matching keys, don't delete them
+DELETE_PREFIX_COUNT_ONLY=0x01
+
+# Datatypes (values compressed by the client are marked in the header).
+# Other servers already use 0x01 (JSON), 0x02 (Snappy) and 0x04 (xattrs),
+# so these codecs live in the high bits.
+DATATYPE_RAW = 0x00
+DATATYPE_ZLIB = 0x40
+DATATYPE_LZ4 = 0x80
+
 MAGIC_BYTE = 0x80
 REQ_MAGIC_BYTE = 0x80
 RES_MAGIC_BYTE = 0x81
@@ -93,8 +113,11 @@ EXTRA_HDR_FMTS={
     CMD_REPLACE: SET_PKT_FMT,
     CMD_INCR: INCRDECR_PKT_FMT,
     CMD_DECR: INCRDECR_PKT_FMT,
+    CMD_INCRQ: INCRDECR_PKT_FMT,
+    CMD_DECRQ: INCRDECR_PKT_FMT,
     CMD_DELETE: DEL_PKT_FMT,
     CMD_FLUSH: FLUSH_PKT_FMT,
+    CMD_DELETE_PREFIX: DELETE_PREFIX_PKT_FMT,
     CMD_TAP_MUTATION: TAP_MUTATION_PKT_FMT,
     CMD_TAP_DELETE: TAP_GENERAL_PKT_FMT,
     CMD_TAP_FLUSH: TAP_GENERAL_PKT_FMT,
@@ -108,5 +131,6 @@ EXTRA_HDR_SIZES=dict(
 ERR_UNKNOWN_CMD = 0x81
 ERR_NOT_FOUND = 0x1
 ERR_EXISTS = 0x2
+ERR_EINVAL = 0x4
 ERR_AUTH = 0x20
 ERR_AUTH_CONTINUE = 0x21
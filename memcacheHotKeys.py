@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Hot key detection in bounded memory.
+
+A Count-Min sketch estimates how often each (sampled) key is seen, and a
+small heavy hitters table remembers the keys with the highest estimates.
+
+Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
+"""
+
+import time
+import random
+
+class CountMinSketch(object):
+    """Approximate counts for an unbounded set of keys.
+
+    Estimates never undercount; they overcount by at most about
+    total / width with probability 1 - 0.5 ** depth."""
+
+    # Mersenne prime for the row hash functions
+    PRIME=(1 << 61) - 1
+
+    def __init__(self, width=1024, depth=4, seed=None):
+        self.width=width
+        self.depth=depth
+        r=random.Random(seed)
+        # One (a, b) pair per row for ((a * h + b) mod PRIME) mod width
+        self.hashes=[(r.randint(1, self.PRIME - 1),
+                      r.randint(0, self.PRIME - 1)) for i in xrange(depth)]
+        self.clear()
+
+    def clear(self):
+        self.tables=[[0] * self.width for i in xrange(self.depth)]
+
+    def _indexes(self, key):
+        h=hash(key) & 0xffffffffffffffff
+        return [((a * h + b) % self.PRIME) % self.width
+                for a, b in self.hashes]
+
+    def add(self, key, n=1):
+        """Count key n more times and return its new estimate."""
+        rv=None
+        for table, i in zip(self.tables, self._indexes(key)):
+            table[i] += n
+            if rv is None or table[i] < rv:
+                rv=table[i]
+        return rv
+
+    def estimate(self, key):
+        return min(table[i]
+                   for table, i in zip(self.tables, self._indexes(key)))
+
+class HotKeyTracker(object):
+    """Tracks the hottest keys seen over a window.
+
+    Only a sampleRate fraction of keys are counted; reported counts and
+    rates are scaled back up.  Once window seconds have passed, counting
+    starts over."""
+
+    def __init__(self, k=10, sampleRate=0.1, window=60, width=1024, depth=4,
+                 clock=time.time):
+        self.k=k
+        self.sampleRate=sampleRate
+        self.window=window
+        self.clock=clock
+        self.sketch=CountMinSketch(width, depth)
+        self.r=random.Random()
+        self.reset()
+
+    def reset(self):
+        """Start a new window."""
+        self.sketch.clear()
+        # Candidate heavy hitters -> estimated (sampled) count
+        self.top={}
+        self.started=self.clock()
+
+    def record(self, key):
+        """Note an access of the given key."""
+        if self.sampleRate < 1 and self.r.random() >= self.sampleRate:
+            return
+        if self.window and self.clock() - self.started >= self.window:
+            self.reset()
+        est=self.sketch.add(key)
+        top=self.top
+        if key in top or len(top) < self.k * 2:
+            top[key]=est
+        else:
+            coldest=min(top, key=top.get)
+            if est > top[coldest]:
+                del top[coldest]
+                top[key]=est
+
+    def hottest(self, n=None):
+        """The hottest keys as a list of (key, estimated count, estimated
+        rate per second), hottest first."""
+        elapsed=max(self.clock() - self.started, 1e-6)
+        rv=sorted(self.top.iteritems(), key=lambda kv: kv[1], reverse=True)
+        rv=rv[:n or self.k]
+        return [(key, int(count / self.sampleRate),
+                 count / self.sampleRate / elapsed) for key, count in rv]
+
+    def stats(self, prefix):
+        """The hottest keys as a stats dict."""
+        rv={}
+        for i, (key, count, rate) in enumerate(self.hottest()):
+            rv['%s:%d:key' % (prefix, i)]=key
+            rv['%s:%d:count' % (prefix, i)]=count
+            rv['%s:%d:rate' % (prefix, i)]="%.2f" % rate
+        return rv
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Cheap tracing into a fixed size ring buffer.
+
+Events are kept as (timestamp, category, level, event, args) tuples and
+nothing is formatted until the buffer is dumped.  Events below the level
+of their category are dropped with a single comparison.
+
+Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
+"""
+
+import time
+import collections
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARNING: 'warning'}
+
+class TraceBuffer(object):
+    """The most recent size trace events at or above their category's
+    level (level for categories without one of their own)."""
+
+    def __init__(self, size=4096, level=INFO, clock=time.time):
+        self.events=collections.deque(maxlen=size)
+        self.level=level
+        # category -> level overriding the default
+        self.levels={}
+        self.clock=clock
+        # Events recorded in all
+        self.total=0
+
+    def setLevel(self, level, category=None):
+        """Set the level of a category, or the default without one."""
+        if category is None:
+            self.level=level
+        else:
+            self.levels[category]=level
+
+    def enabled(self, category, level):
+        """Whether an event would be recorded (to skip building costly
+        arguments)."""
+        return level >= self.levels.get(category, self.level)
+
+    def record(self, category, level, event, *args):
+        if level < self.levels.get(category, self.level):
+            return
+        self.total += 1
+        self.events.append((self.clock(), category, level, event, args))
+
+    def clear(self):
+        self.events.clear()
+
+    def format(self, entry):
+        when, category, level, event, args=entry
+        return "%.6f %s %s %s" % (when, LEVEL_NAMES.get(level, level),
+            category, ' '.join([event] + [repr(a) for a in args]))
+
+    def dump(self, f):
+        """Write the buffered events to a file, oldest first."""
+        for e in list(self.events):
+            f.write(self.format(e) + "\n")
+        f.flush()
+
+    def stats(self):
+        """The buffered events, most recent first, as a stats dict."""
+        rv={'size': self.events.maxlen, 'total': self.total,
+            'level': LEVEL_NAMES.get(self.level, self.level)}
+        for category, level in self.levels.iteritems():
+            rv['level:' + category]=LEVEL_NAMES.get(level, level)
+        for i, e in enumerate(reversed(self.events)):
+            rv['%d' % i]=self.format(e)
+        return rv
@@ -5,29 +5,519 @@ Binary memcached test client.
 Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
 """
 
+import os
 import sys
+import mmap
+import stat
 import time
 import hmac
 import socket
 import random
 import struct
+import asyncore
+import StringIO
+import tempfile
+import threading
 import exceptions
 
 import unittest
 
+import testServer
 import memcacheConstants
+import memcacheHotKeys
+import memcacheTrace
+import mc_replay
+import mc_bin_client
+import mc_replica_client
+import memcacheCapture
 from mc_bin_client import MemcachedClient, MemcachedError
 
-class ComplianceTest(unittest.TestCase):
+class ManualClock(object):
+    """A clock that only moves when told to."""
+
+    def __init__(self, now=1234567890.0):
+        self.now=now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class InProcessServer(threading.Thread):
+    """A test server on a free port, served from a background thread.
+
+    Each test process (e.g. each parallel worker) gets its own.  Given a
+    path, it listens on a unix domain socket there instead."""
+
+    def __init__(self, path=None, mode=None):
+        threading.Thread.__init__(self)
+        self.daemon=True
+        self.map={}
+        self.clock=ManualClock()
+        self.server=testServer.MemcachedServer(testServer.DictBackend(),
+            testServer.MemcachedBinaryChannel, port=0, map=self.map,
+            path=path, mode=mode)
+        self.port=self.server.port
+        self.reset()
+
+    def reset(self, **kwargs):
+        """Start over with an empty backend on a fresh clock.
+
+        Only connections made after this see the new backend."""
+        self.clock=ManualClock()
+        self.server.backend=testServer.DictBackend(self.clock, **kwargs)
+
+    def run(self):
+        asyncore.loop(0.05, map=self.map)
+
+    def stop(self):
+        asyncore.close_all(self.map)
+        self.join()
+
+_server=None
+
+def inProcessServer():
+    """Get the server for this process, or None when the tests should run
+    against the server named in MEMCACHED_SERVER (host:port)."""
+    global _server
+    if os.environ.get('MEMCACHED_SERVER'):
+        return None
+    if _server is None:
+        _server=InProcessServer()
+        _server.start()
+    return _server
+
+def tearDownModule():
+    """Stop this process's server so its thread doesn't outlive the
+    interpreter's shutdown."""
+    global _server
+    if _server is not None:
+        _server.stop()
+        _server=None
+
+class HotKeyTrackerTest(unittest.TestCase):
+
+    def testHeavyHitters(self):
+        """Test the heavy hitters survive a stream of one-off keys."""
+        t=memcacheHotKeys.HotKeyTracker(k=3, sampleRate=1.0)
+        for i in range(2000):
+            t.record('k%d' % i)
+            if i % 4 == 0:
+                t.record('a')
+            if i % 8 == 0:
+                t.record('b')
+        self.assertEquals(['a', 'b'], [h[0] for h in t.hottest(2)])
+        self.assertTrue(t.hottest(1)[0][1] >= 500)
+
+    def testWindow(self):
+        """Test counting starts over once the window has passed."""
+        now=[0]
+        t=memcacheHotKeys.HotKeyTracker(sampleRate=1.0, window=10,
+                                        clock=lambda: now[0])
+        t.record('a')
+        now[0]=11
+        t.record('b')
+        self.assertEquals(['b'], [h[0] for h in t.hottest()])
+
+class UnixSocketTest(unittest.TestCase):
 
     def setUp(self):
-        self.mc=MemcachedClient()
-        self.mc.flush()
+        self.dir=tempfile.mkdtemp()
+        self.path=os.path.join(self.dir, 'mc.sock')
+        self.server=InProcessServer(self.path, 0600)
+        self.server.start()
 
     def tearDown(self):
+        self.server.stop()
+        os.rmdir(self.dir)
+
+    def testSetGet(self):
+        """Test a set and get over a unix domain socket."""
+        mc=MemcachedClient(self.path)
+        mc.set("x", 5, 19, "somevalue")
+        self.assertEquals((19, "somevalue"), mc.get("x")[::2])
+        mc.close()
+
+    def testPermissions(self):
+        """Test the socket gets the requested permissions."""
+        self.assertEquals(0600, stat.S_IMODE(os.stat(self.path).st_mode))
+
+    def testUmaskRestored(self):
+        """Test the process umask is put back after binding."""
+        umask=os.umask(022)
+        os.umask(umask)
+        path=os.path.join(self.dir, 'other.sock')
+        server=InProcessServer(path, 0600)
+        server.server.close()
+        self.assertEquals(umask, os.umask(umask))
+
+class PrefixIndexTest(unittest.TestCase):
+
+    def testIndex(self):
+        """Test keys come and go from the index."""
+        i=testServer.PrefixIndex()
+        for k in ['a', 'ab', 'abc', 'abd', 'b']:
+            i.add(k)
+        i.add('ab')
+        self.assertEquals(5, i.count(''))
+        self.assertEquals(4, i.count('a'))
+        self.assertEquals(['ab', 'abc', 'abd'], sorted(i.keys('ab')))
+        i.remove('ab')
+        i.remove('zz')
+        self.assertEquals(['abc', 'abd'], sorted(i.keys('ab')))
+        i.remove('abc')
+        i.remove('abd')
+        self.assertEquals(0, i.count('ab'))
+        self.assertEquals(['a', 'b'], sorted(i.keys('')))
+        self.assertFalse('ab' in i)
+
+class NegativeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock=ManualClock()
+        self.cache=mc_bin_client.NegativeCache(ttl=2, size=3, clock=self.clock)
+
+    def testExpiry(self):
+        """Test misses are only remembered for the TTL."""
+        self.cache.add("x")
+        self.clock.advance(1.9)
+        self.assertTrue("x" in self.cache)
+        self.clock.advance(0.1)
+        self.assertFalse("x" in self.cache)
+        self.assertEquals(0, len(self.cache))
+
+    def testBounded(self):
+        """Test the oldest misses are dropped beyond the size."""
+        for k in "abcd":
+            self.cache.add(k)
+        self.cache.add("b")
+        self.cache.add("e")
+        self.assertEquals(["b", "d", "e"],
+                          sorted(k for k in "abcde" if k in self.cache))
+
+    def testDiscard(self):
+        self.cache.add("x")
+        self.cache.discard("x")
+        self.cache.discard("y")
+        self.assertFalse("x" in self.cache)
+
+class TraceBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock=ManualClock()
+        self.trace=memcacheTrace.TraceBuffer(size=3, clock=self.clock)
+
+    def testLevels(self):
+        """Test events below their category's level are dropped."""
+        self.trace.setLevel(memcacheTrace.DEBUG, 'storage')
+        self.trace.record('cmd', memcacheTrace.DEBUG, 'noop')
+        self.trace.record('storage', memcacheTrace.DEBUG, 'miss', 'x')
+        self.trace.record('auth', memcacheTrace.INFO, 'ok')
+        self.assertEquals(['miss', 'ok'], [e[3] for e in self.trace.events])
+        self.assertFalse(self.trace.enabled('cmd', memcacheTrace.DEBUG))
+        self.assertTrue(self.trace.enabled('storage', memcacheTrace.DEBUG))
+
+    def testRing(self):
+        """Test only the most recent events are kept."""
+        for i in range(5):
+            self.trace.record('cmd', memcacheTrace.INFO, 'event', i)
+        self.assertEquals([(2,), (3,), (4,)],
+                          [e[4] for e in self.trace.events])
+        stats=self.trace.stats()
+        self.assertEquals(5, stats['total'])
+        self.assertEquals("1234567890.000000 info cmd event 4", stats['0'])
+
+    def testDump(self):
+        self.trace.record('storage', memcacheTrace.WARNING, 'odd', 'x', 1)
+        f=StringIO.StringIO()
+        self.trace.dump(f)
+        self.assertEquals("1234567890.000000 warning storage odd 'x' 1\n",
+                          f.getvalue())
+
+class StallingBackend(testServer.DictBackend):
+    """A backend that takes `stall` seconds to answer reads."""
+
+    stall=0
+
+    def handle_get(self, cmd, hdrs, key, cas, data):
+        time.sleep(self.stall)
+        return testServer.DictBackend.handle_get(self, cmd, hdrs, key, cas,
+                                                 data)
+
+class ReplicatedClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers=[InProcessServer() for i in range(3)]
+        for s in self.servers:
+            s.server.backend=StallingBackend()
+            s.start()
+        self.mc=mc_replica_client.ReplicatedClient(
+            ['127.0.0.1:%d' % s.port for s in self.servers], replicas=2,
+            timeout=0.5, hedgeDelay=0.02, retryInterval=5, clock=time.time)
+
+    def tearDown(self):
+        self.mc.close()
+        for s in self.servers:
+            s.stop()
+
+    def server(self, node):
+        return self.servers[self.mc.nodes.index(node)]
+
+    def testReplicatedSetGet(self):
+        """Test writes land on both replicas of a key."""
+        self.mc.set("x", 5, 19, "somevalue")
+        self.assertEquals((19, "somevalue"), self.mc.get("x")[::2])
+        for node in self.mc._replicas("x"):
+            self.assertTrue("x" in self.server(node).server.backend.storage)
+        self.assertRaises(MemcachedError, self.mc.get, "missing")
+
+    def testHedgedRead(self):
+        """Test a stalled primary is hedged to its replica."""
+        self.mc.set("x", 5, 19, "somevalue")
+        primary=self.mc._replicas("x")[0]
+        self.server(primary).server.backend.stall=0.3
+        start=time.time()
+        self.assertEquals((19, "somevalue"), self.mc.get("x")[::2])
+        self.assertTrue(time.time() - start < 0.2)
+        # The slow connection was abandoned, not counted as failed.
+        self.assertEquals(0, primary.failures)
+        self.assertEquals((19, "somevalue"), self.mc.get("x")[::2])
+
+    def testDeadline(self):
+        """Test a read gives up when no replica answers in time."""
+        self.mc.set("x", 5, 19, "somevalue")
+        for node in self.mc._replicas("x"):
+            self.server(node).server.backend.stall=0.8
+        start=time.time()
+        self.assertRaises(mc_replica_client.NodesUnavailable,
+                          self.mc.get, "x")
+        self.assertTrue(time.time() - start < 0.7)
+
+    def testFailover(self):
+        """Test a dead node is ejected and reads fail over to a replica."""
+        self.mc.timeout=0.2
+        self.mc.set("x", 5, 19, "somevalue")
+        primary=self.mc._replicas("x")[0]
+        self.server(primary).stop()
+        for i in range(3):
+            self.assertEquals((19, "somevalue"), self.mc.get("x")[::2])
+        self.assertEquals((True, 3),
+                          self.mc.health()[primary.addr])
+
+    def testWritesDontSkewHedging(self):
+        """Test only reads feed the hedging latencies."""
+        for i in range(5):
+            self.mc.set("x", 5, 19, "somevalue")
+        self.mc.get("x")
+        self.assertEquals(1, sum(len(n.latencies) for n in self.mc.nodes))
+
+    def testPercentileResorting(self):
+        """Test percentiles are only worked out again every so often."""
+        node=mc_replica_client.Node('127.0.0.1:1')
+        for i in range(20):
+            node.succeeded(0.001)
+        self.assertEquals(0.001, node.percentile(0.9))
+        for i in range(node.RESORT_SAMPLES - 1):
+            node.succeeded(1.0)
+        self.assertEquals(0.001, node.percentile(0.9))
+        node.succeeded(1.0)
+        self.assertEquals(1.0, node.percentile(0.9))
+
+    def testProbe(self):
+        """Test an ejected node is probed with a noop once its time is up."""
+        now=[0]
+        node=mc_replica_client.Node('127.0.0.1:%d' % self.servers[0].port,
+                                    failureThreshold=1, retryInterval=5,
+                                    clock=lambda: now[0])
+        node.failed()
+        self.assertFalse(node.available(0.5))
+        now[0]=6
+        self.assertTrue(node.available(0.5))
+        self.assertEquals(None, node.ejectedUntil)
+
+class ServerDiagnosticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server=InProcessServer()
+        self.server.server.backend=StallingBackend()
+        self.server.start()
+        self.mc=MemcachedClient('127.0.0.1', self.server.port)
+
+    def tearDown(self):
+        self.mc.close()
+        self.server.stop()
+
+    def testSlowLog(self):
+        """Test slow commands are recorded."""
+        backend=self.server.server.backend
+        backend.slowlog.threshold=0.05
+        self.mc.set("fast", 0, 0, "value")
+        backend.stall=0.06
+        self.mc.get("fast")
+        stats=self.mc.stats('slowlog')
+        self.assertEquals('1', stats['total'])
+        self.assertEquals('fast', stats['0:key'])
+        self.assertEquals('CMD_GET', stats['0:cmd'])
+        self.assertEquals('9', stats['0:response'])
+        self.assertTrue(int(stats['0:duration_us']) >= 50000)
+        self.mc.stats('slowlog reset')
+        self.assertEquals('0', self.mc.stats('slowlog')['total'])
+
+    def testTrace(self):
+        """Test the trace buffer can be read and configured over stats."""
+        self.mc.set("x", 0, 0, "value")
+        self.assertFalse('0' in self.mc.stats('trace'))
+        self.assertEquals('debug', self.mc.stats('trace debug')['level'])
+        self.assertRaises(MemcachedError, self.mc.get, "missing")
+        stats=self.mc.stats('trace')
+        self.assertEquals('debug', stats['level'])
+        self.assertTrue(stats['0'].endswith(" debug storage miss 'missing'"))
+        self.mc.stats('trace reset')
+        self.mc.stats('trace info')
         self.mc.flush()
+        stats=self.mc.stats('trace')
+        self.assertTrue(stats['0'].endswith(" info storage flushed"))
+        self.assertFalse('1' in stats)
+
+    def testProfile(self):
+        """Test profiling can be turned on and off at runtime."""
+        self.assertEquals('stopped', self.mc.stats('profile stop')['status'])
+        self.assertEquals('running', self.mc.stats('profile start')['status'])
+        for i in range(10):
+            self.mc.set("x", 0, 0, "value")
+        stats=self.mc.stats('profile stop')
+        self.assertEquals('stopped', stats['status'])
+        self.assertTrue('handle_set' in stats['report'])
+
+class CaptureReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers=[]
+
+    def tearDown(self):
+        for s in self.servers:
+            s.stop()
+
+    def startServer(self, capture=None):
+        server=InProcessServer()
+        server.server.capture=capture
+        server.start()
+        self.servers.append(server)
+        return server
+
+    def record(self):
+        """Capture some traffic on the server side, returning the capture
+        grouped by connection.
+
+        Connections use their own keys since a fast replay runs them
+        concurrently."""
+        f=StringIO.StringIO()
+        server=self.startServer(memcacheCapture.CaptureWriter(f))
+        for i in range(2):
+            mc=MemcachedClient('127.0.0.1', server.port)
+            mc.add("x%d" % i, 0, 19, "somevalue")
+            mc.get("x%d" % i)
+            mc.getMulti(["x%d" % i, "y%d" % i, "missing"])
+            mc.incr("counter%d" % i)
+            mc.close()
+        mc=MemcachedClient('127.0.0.1', server.port)
+        mc.noop()
+        mc.close()
+        server.stop()
+        f.seek(0)
+        return mc_replay.loadCapture(f)
+
+    def testCapture(self):
+        """Test the server records every request and response."""
+        conns=self.record()
+        self.assertEquals(3, len(conns))
+        requests, responses=conns[1]
+        # add, get, 3 getkqs and a noop, incr
+        self.assertEquals(7, len(requests))
+        self.assertEquals(5, len(responses))
+
+    def testClientCapture(self):
+        """Test a client can record its own traffic."""
+        f=StringIO.StringIO()
+        server=self.startServer()
+        mc=MemcachedClient('127.0.0.1', server.port)
+        mc.start_capture(memcacheCapture.CaptureWriter(f))
+        mc.set("x", 0, 19, "somevalue")
+        mc.get("x")
+        mc.stop_capture()
+        mc.noop()
+        mc.close()
+        f.seek(0)
+        records=list(memcacheCapture.readCapture(f))
+        self.assertEquals([memcacheCapture.DIR_REQUEST,
+                           memcacheCapture.DIR_RESPONSE] * 2,
+                          [r[0] for r in records])
+
+    def testReplay(self):
+        """Test replaying a capture against a fresh server."""
+        conns=self.record()
+        server=self.startServer()
+        rv=mc_replay.replay(conns, '127.0.0.1:%d' % server.port, speed=0)
+        self.assertEquals(15, rv['requests'])
+        self.assertEquals({}, rv['errors'])
+        self.assertEquals({}, rv['mismatches'])
+        self.assertTrue(rv['p50'] > 0)
+
+    def testReplayLatencies(self):
+        """Test every response is timed against its own request, quiet
+        requests without one included."""
+        requests, responses=self.record()[1]
+        server=self.startServer()
+        conn=mc_replay.Connection('127.0.0.1:%d' % server.port, requests,
+                                  responses)
+        t=threading.Thread(target=conn.receive)
+        t.start()
+        conn.send(time.time(), requests[0][0], 0)
+        t.join()
+        conn.s.close()
+        self.assertEquals(None, conn.error)
+        self.assertEquals(len(responses), len(conn.latencies))
+        self.assertEquals(0, len(conn.outstanding))
+
+    def testReplayMismatch(self):
+        """Test responses that differ from the capture are reported."""
+        conns=self.record()
+        server=self.startServer()
+        mc=MemcachedClient('127.0.0.1', server.port)
+        mc.set("x0", 0, 19, "othervalue")
+        rv=mc_replay.replay(conns, '127.0.0.1:%d' % server.port, speed=0)
+        self.assertEquals([1], rv['mismatches'].keys())
+        # The add fails and the get sees the other value.
+        self.assertEquals([0, 1], [m[0] for m in rv['mismatches'][1][:2]])
+
+class ComplianceTest(unittest.TestCase):
+
+    # Arguments for the in-process server's backend
+    backendArgs={}
+
+    def setUp(self):
+        self.server=inProcessServer()
+        if self.server:
+            self.server.reset(**self.backendArgs)
+            self.mc=MemcachedClient('127.0.0.1', self.server.port)
+        else:
+            host, port=os.environ['MEMCACHED_SERVER'].split(':')
+            self.mc=MemcachedClient(host, int(port))
+            self.mc.flush()
+
+    def tearDown(self):
+        if not self.server:
+            self.mc.flush()
         self.mc.close()
 
+    def sleep(self, seconds):
+        """Let time pass on the server."""
+        if self.server:
+            self.server.clock.advance(seconds)
+        else:
+            time.sleep(seconds)
+
     def testVersion(self):
         """Test the version command returns something."""
         v=self.mc.version()
@@ -41,7 +531,7 @@ class ComplianceTest(unittest.TestCase):
     def testZeroExpiration(self):
         """Ensure zero-expiration sets work properly."""
         self.mc.set("x", 0, 19, "somevalue")
-        time.sleep(1.1)
+        self.sleep(1.1)
         self.assertGet((19, "somevalue"), self.mc.get("x"))
 
     def assertNotExists(self, key):
@@ -110,6 +600,63 @@ class ComplianceTest(unittest.TestCase):
         self.assertGet((2, 'why'), vals['y'])
         self.assertEquals(2, len(vals))
 
+    def testMultiGetDuplicates(self):
+        """Test multiget asks for repeated keys once."""
+        self.mc.add("x", 5, 1, "ex")
+        vals=self.mc.getMulti(['x', 'y', 'x'])
+        self.assertEquals(['x'], vals.keys())
+        self.assertGet((1, 'ex'), vals['x'])
+
+    def testGetK(self):
+        """Test GETK responses carry the key."""
+        self.mc.set("x", 5, 19, "somevalue")
+        self.mc._sendCmd(memcacheConstants.CMD_GETK, "x", '', 1)
+        cmd, opaque, cas, keylen, extralen, data= \
+            self.mc._handleKeyedResponse(1)
+        self.assertEquals((1, 4), (keylen, extralen))
+        self.assertEquals(('x', (19, cas, 'somevalue')),
+                          self.mc._parseGetk(cas, keylen, extralen, data))
+        self.mc._sendCmd(memcacheConstants.CMD_GETK, "missing", '', 2)
+        magic, cmd, keylen, extralen, dtype, errcode, bodylen, opaque, cas= \
+            self.mc._readHeader(2)
+        self.assertEquals(memcacheConstants.ERR_NOT_FOUND, errcode)
+        self.assertEquals("missing", self.mc._recvBody(bodylen)[:keylen])
+
+    def testGetKQ(self):
+        """Test GETKQ only answers hits."""
+        self.mc.set("x", 5, 19, "somevalue")
+        self.mc._sendCmd(memcacheConstants.CMD_GETKQ, "missing", '', 1)
+        self.mc._sendCmd(memcacheConstants.CMD_GETKQ, "x", '', 2)
+        cmd, opaque, cas, keylen, extralen, data= \
+            self.mc._handleKeyedResponse(2)
+        self.assertEquals(memcacheConstants.CMD_GETKQ, cmd)
+        self.assertEquals('x', data[extralen:extralen + keylen])
+        self.mc.noop()
+
+    def testErrorHasNoKey(self):
+        """Test error responses don't claim to carry a key or extras."""
+        self.mc._sendCmd(memcacheConstants.CMD_GET, "missing", '', 1)
+        hdr=self.mc._readHeader(1)
+        self.assertEquals((0, 0), hdr[2:4])
+        self.mc._recvBody(hdr[6])
+
+    def testResponseLengths(self):
+        """Test replies without a key or extras don't claim any."""
+        requests=[(memcacheConstants.CMD_SET, "key", "value",
+                   struct.pack(memcacheConstants.SET_PKT_FMT, 19, 0)),
+                  (memcacheConstants.CMD_INCR, "cnt", '',
+                   struct.pack(memcacheConstants.INCRDECR_PKT_FMT, 1, 0, 0)),
+                  (memcacheConstants.CMD_DELETE, "key", '', '')]
+        for i, (cmd, key, val, extras) in enumerate(requests):
+            self.mc._sendCmd(cmd, key, val, i, extras)
+            hdr=self.mc._readHeader(i)
+            keylen, extralen, bodylen=hdr[2], hdr[3], hdr[6]
+            self.assertEquals(0, hdr[5])
+            self.assertTrue(keylen + extralen <= bodylen,
+                            "cmd 0x%x: keylen=%d extralen=%d bodylen=%d"
+                            % (cmd, keylen, extralen, bodylen))
+            self.mc._recvBody(bodylen)
+
     def testIncrDoesntExistNoCreate(self):
         """Testing incr when a value doesn't exist (and not creating)."""
         try:
@@ -269,13 +816,347 @@ class ComplianceTest(unittest.TestCase):
             self.assertEquals(memcacheConstants.ERR_EXISTS, e.status)
         self.assertGet((19, 'some'), self.mc.get("x"))
 
+    def testStats(self):
+        """Test the general stats group."""
+        self.mc.set("x", 5, 19, "somevalue")
+        stats=self.mc.stats()
+        self.assertTrue('pid' in stats)
+        self.assertEquals('1', stats['curr_items'])
+
+    def testCompression(self):
+        """Test values are compressed above the threshold only."""
+        big='{"some": "json", "blob": [%s]}' % ', '.join(['1'] * 1000)
+        self.mc.enable_compression('zlib', threshold=100)
+        self.mc.set("x", 5, 19, big)
+        self.mc.set("y", 5, 17, "small")
+        self.assertGet((19, big), self.mc.get("x"))
+        self.assertGet((17, "small"), self.mc.get("y"))
+        vals=self.mc.getMulti(['x', 'y'])
+        self.assertGet((19, big), vals['x'])
+        stats=self.mc.stats()
+        self.assertEquals('1', stats['compressed_items'])
+        self.assertTrue(float(stats['compression_ratio']) > 1)
+
+    def testCompressionStatsTotals(self):
+        """Test storage stats follow overwrites, appends and deletes."""
+        self.mc.enable_compression('zlib', threshold=100)
+        self.mc.set("x", 5, 19, 'x' * 500)
+        self.mc.set("y", 5, 19, 'y' * 1000)
+        self.mc.set("y", 5, 19, 'y' * 2000)
+        stats=self.mc.stats()
+        self.assertEquals('2', stats['compressed_items'])
+        self.assertEquals('2500', stats['compressed_raw_bytes'])
+        self.mc.append("x", "tail")
+        self.mc.incr("n", init=1234)
+        stats=self.mc.stats()
+        self.assertEquals('1', stats['compressed_items'])
+        self.assertEquals('2000', stats['compressed_raw_bytes'])
+        self.assertEquals(str(504 + 4 + int(stats['compressed_bytes'])),
+                          stats['bytes'])
+        self.mc.delete("y")
+        stats=self.mc.stats()
+        self.assertEquals(('0', '0', '508'), (stats['compressed_items'],
+            stats['compressed_raw_bytes'], stats['bytes']))
+        self.mc.flush()
+        self.assertEquals('0', self.mc.stats()['bytes'])
+
+    def testCompressedAppend(self):
+        """Test appending to a compressed value."""
+        big='x' * 500
+        self.mc.enable_compression('zlib', threshold=100)
+        self.mc.set("x", 5, 19, big)
+        self.mc.append("x", "tail")
+        self.assertGet((19, big + "tail"), self.mc.get("x"))
+
+    def testUnknownDatatype(self):
+        """Test values in a datatype the server can't decode are refused."""
+        for dtype in (0x01, 0x02, 0x04):
+            self.mc._sendCmd(memcacheConstants.CMD_SET, "x", "value", dtype,
+                             mc_bin_client.SET_PKT.pack(19, 0), dtype=dtype)
+            try:
+                self.mc._handleSingleResponse(dtype)
+                self.fail("Expected datatype 0x%x to be refused" % dtype)
+            except MemcachedError, e:
+                self.assertEquals(memcacheConstants.ERR_EINVAL, e.status)
+        self.assertNotExists("x")
+
+    def testCompressionUnknownCodec(self):
+        """Test an unavailable codec is refused."""
+        self.assertRaises(ValueError, self.mc.enable_compression, 'bogus')
+
+    def testStreamingSetGet(self):
+        """Test streaming a value in and out in pieces."""
+        big=''.join(chr(i % 256) for i in xrange(300000))
+        self.mc.CHUNK_SIZE=4096
+        self.mc.set_from("x", 5, 19, StringIO.StringIO(big), len(big))
+        self.assertGet((19, big), self.mc.get("x"))
+        out=StringIO.StringIO()
+        flags, cas, length=self.mc.get_into("x", out)
+        self.assertEquals((19, len(big)), (flags, length))
+        self.assertEquals(big, out.getvalue())
+        buf=bytearray(len(big) + 10)
+        flags, cas, length=self.mc.get_into("x", buf)
+        self.assertEquals(big, str(buf[:length]))
+
+    def testStreamingGetIntoMmap(self):
+        """Test streaming a value into an mmap."""
+        self.mc.set("x", 5, 19, "somevalue")
+        m=mmap.mmap(-1, 100)
+        flags, cas, length=self.mc.get_into("x", m)
+        self.assertEquals("somevalue", m[:length])
+
+    def testStreamingGetIntoMmapReused(self):
+        """Test every value goes to the start of a reused mmap."""
+        m=mmap.mmap(-1, 100)
+        for val in ("first value", "second"):
+            self.mc.set("x", 5, 19, val)
+            flags, cas, length=self.mc.get_into("x", m)
+            self.assertEquals(val, m[:length])
+
+    def testStreamingGetIntoSmallMmap(self):
+        """Test a too small mmap is refused without breaking the
+        connection."""
+        big='x' * 300000
+        self.mc.set("x", 5, 19, big)
+        m=mmap.mmap(-1, 1000)
+        self.assertRaises(ValueError, self.mc.get_into, "x", m)
+        self.assertGet((19, big), self.mc.get("x"))
+
+    def testStreamingGetIntoSmallBuffer(self):
+        """Test a too small buffer is refused without breaking the
+        connection."""
+        self.mc.set("x", 5, 19, "somevalue")
+        self.assertRaises(ValueError, self.mc.get_into, "x", bytearray(3))
+        self.assertGet((19, "somevalue"), self.mc.get("x"))
+
+    def testStreamingGetIntoSmallBufferCompressed(self):
+        """Test a too small buffer is refused for a compressed value."""
+        big='x' * 5000
+        self.mc.enable_compression('zlib', threshold=100)
+        self.mc.set("x", 5, 19, big)
+        buf=bytearray(10)
+        self.assertRaises(ValueError, self.mc.get_into, "x", buf)
+        self.assertEquals(10, len(buf))
+        self.assertRaises(ValueError, self.mc.get_into, "x", mmap.mmap(-1, 10))
+        m=mmap.mmap(-1, len(big))
+        self.assertEquals((19, len(big)), self.mc.get_into("x", m)[::2])
+        self.assertEquals(big, m[:])
+
+    def testStreamingGetMissing(self):
+        """Test streaming a missing value."""
+        try:
+            self.mc.get_into("x", bytearray(10))
+            self.fail("Expected an exception")
+        except MemcachedError, e:
+            self.assertEquals(memcacheConstants.ERR_NOT_FOUND, e.status)
+
+    def testHotKeyStats(self):
+        """Test the hottest read key shows up in the hotkeys stats."""
+        self.mc.set("hot", 5, 19, "somevalue")
+        self.mc.set("cold", 5, 19, "somevalue")
+        for i in range(500):
+            self.mc.get("hot")
+        self.mc.get("cold")
+        stats=self.mc.stats('hotkeys')
+        self.assertEquals('hot', stats['read:0:key'])
+        self.assertTrue(float(stats['read:0:rate']) > 0)
+
+    def testClientHotKeys(self):
+        """Test the client side hot key tracker."""
+        self.mc.set("x", 5, 19, "somevalue")
+        self.assertEquals([], self.mc.hot_keys())
+        self.mc.track_hot_keys(k=2)
+        for i in range(10):
+            self.mc.get("x")
+        self.mc.getMulti(['x', 'y'])
+        self.assertEquals([('x', 11), ('y', 1)],
+                          [h[:2] for h in self.mc.hot_keys()])
+
+    def testManyAppendsAndPrepends(self):
+        """Test building a large value with appends and prepends."""
+        self.mc.set("x", 5, 19, "|")
+        expected="|"
+        for i in range(300):
+            self.mc.append("x", "a%03d" % i * 10)
+            self.mc.prepend("x", "p%03d" % i)
+            expected="p%03d" % i + expected + "a%03d" % i * 10
+        self.assertGet((19, expected), self.mc.get("x"))
+        self.mc.append("x", "end")
+        self.assertGet((19, expected + "end"), self.mc.get("x"))
+
+    def testIncrAfterAppends(self):
+        """Test incr and CAS on a value built by appends."""
+        if self.server:
+            # Make sure the value is kept in chunks.
+            self.server.server.backend.CHUNK_THRESHOLD=1
+        self.mc.set("x", 5, 19, "1")
+        for c in "2345":
+            val, cas, something=self.mc.append("x", c)
+        self.assertValidCas("x", cas)
+        self.assertEquals(12346, self.mc.incr("x")[0])
+        self.mc.append("x", "0")
+        flags, cas, val=self.mc.get("x")
+        self.assertEquals("123460", val)
+        self.mc.cas("x", 5, 19, cas, "replaced")
+        self.assertGet((19, "replaced"), self.mc.get("x"))
+
+    def testDeletePrefix(self):
+        """Test deleting and counting keys by prefix."""
+        for k in ['t1:a', 't1:b', 't1:c:d', 't2:a', 't']:
+            self.mc.set(k, 5, 19, k)
+        self.assertEquals(3, self.mc.delete_prefix('t1:', countOnly=True))
+        self.assertGet((19, 't1:a'), self.mc.get('t1:a'))
+        self.assertEquals(3, self.mc.delete_prefix('t1:'))
+        for k in ['t1:a', 't1:b', 't1:c:d']:
+            self.assertNotExists(k)
+        self.assertGet((19, 't2:a'), self.mc.get('t2:a'))
+        self.assertGet((19, 't'), self.mc.get('t'))
+        self.assertEquals(0, self.mc.delete_prefix('t1:'))
+
+    def testDeletePrefixExpired(self):
+        """Test expired keys aren't counted or deleted by prefix."""
+        self.mc.set('t:short', 1, 19, 'x')
+        self.mc.set('t:long', 10, 19, 'x')
+        self.sleep(2)
+        self.assertEquals(1, self.mc.delete_prefix('t:', countOnly=True))
+        self.assertEquals(1, self.mc.delete_prefix('t:'))
+        self.assertEquals(0, self.mc.delete_prefix('t:', countOnly=True))
+
+    def testIncrMulti(self):
+        """Test applying a batch of counter deltas."""
+        self.mc.incr("a", 5, init=5)
+        rv=self.mc.incr_multi({"a": 3, "b": -2, "c": 0}, init=10)
+        self.assertEquals(["a", "b"], sorted(rv.keys()))
+        self.assertEquals(8, rv["a"][0])
+        # Created as init plus the delta
+        self.assertEquals(8, rv["b"][0])
+        self.assertValidCas("b", rv["b"][1])
+        rv=self.mc.incr_multi({"a": 1, "b": -2, "missing": 1},
+                              exp=memcacheConstants.INCRDECR_SPECIAL,
+                              quiet=True)
+        self.assertEquals(None, rv["a"])
+        self.assertEquals(memcacheConstants.ERR_NOT_FOUND,
+                          rv["missing"].status)
+        self.assertEquals(9, self.mc.incr("a", 0)[0])
+        self.assertEquals(6, self.mc.decr("b", 0)[0])
+
+    def testCounterAggregator(self):
+        """Test counter deltas are batched up until a flush trigger."""
+        now=[0]
+        flushes=[]
+        agg=mc_bin_client.CounterAggregator(self.mc, interval=10, maxKeys=3,
+            onFlush=flushes.append, clock=lambda: now[0])
+        for i in range(100):
+            agg.incr("a")
+            agg.decr("b", 2)
+        self.assertEquals([], flushes)
+        self.assertNotExists("a")
+        now[0]=10
+        agg.incr("a")
+        self.assertEquals(1, len(flushes))
+        self.assertEquals(101, flushes[0]["a"][0])
+        self.assertEquals(0, flushes[0]["b"][0])
+        agg.incr("x")
+        agg.incr("y")
+        agg.incr("z")
+        self.assertEquals(["x", "y", "z"], sorted(flushes[1].keys()))
+        agg.incr("a")
+        self.assertEquals(102, agg.flush()["a"][0])
+        self.assertEquals({}, agg.flush())
+
+    def testCounterAggregatorFlushIfDue(self):
+        """Test a quiet aggregator's last batch is sent once it's due."""
+        now=[0]
+        agg=mc_bin_client.CounterAggregator(self.mc, interval=10,
+                                            clock=lambda: now[0])
+        agg.incr("a", 5)
+        self.assertEquals(None, agg.flush_if_due())
+        now[0]=10
+        self.assertEquals(5, agg.flush_if_due()["a"][0])
+        self.assertEquals(None, agg.flush_if_due())
+
+    def testCounterAggregatorFailedFlush(self):
+        """Test deltas of a failed flush are kept for the next one."""
+        class Broken(object):
+            def incr_multi(self, *args):
+                raise socket.error("connection reset")
+        agg=mc_bin_client.CounterAggregator(Broken())
+        agg.incr("a", 3)
+        agg.decr("b")
+        self.assertRaises(socket.error, agg.flush)
+        self.assertEquals({"a": 3, "b": -1}, agg.pending)
+        agg.incr("a")
+        agg.client=self.mc
+        rv=agg.flush()
+        self.assertEquals(4, rv["a"][0])
+        self.assertEquals(0, rv["b"][0])
+
+    def testCounterAggregatorAnyFailure(self):
+        """Test deltas are kept whatever a flush fails with."""
+        class Broken(object):
+            def incr_multi(self, *args):
+                raise struct.error("garbled")
+        agg=mc_bin_client.CounterAggregator(Broken())
+        agg.incr("a", 3)
+        self.assertRaises(struct.error, agg.flush)
+        self.assertEquals({"a": 3}, agg.pending)
+
+    def testIncrMultiSkipsStaleResponses(self):
+        """Test a batch ignores responses left by an abandoned one."""
+        self.mc._sendCmd(memcacheConstants.CMD_INCR, "a", '', 0,
+                         mc_bin_client.INCRDECR_PKT.pack(1, 1000, 0))
+        self.mc._sendCmd(memcacheConstants.CMD_NOOP, '', '', 1)
+        rv=self.mc.incr_multi({"b": 5})
+        self.assertEquals(["b"], rv.keys())
+        self.assertEquals(5, rv["b"][0])
+        self.assertEquals(1000, self.mc.incr("a", 0)[0])
+
+    def testNegativeCache(self):
+        """Test the client remembers misses until they expire."""
+        clock=ManualClock()
+        self.mc.enable_negative_cache(ttl=1, clock=clock)
+        self.assertNotExists("x")
+        other=MemcachedClient(*self.mc.s.getpeername())
+        try:
+            other.set("x", 0, 19, "somevalue")
+        finally:
+            other.close()
+        # Still a (stale) miss here; the server isn't asked.
+        self.assertNotExists("x")
+        self.assertEquals({}, self.mc.getMulti(["x"]))
+        clock.advance(1)
+        self.assertGet((19, "somevalue"), self.mc.get("x"))
+
+    def testNegativeCacheOwnWrites(self):
+        """Test this client's writes are never hidden by cached misses."""
+        self.mc.enable_negative_cache(ttl=60)
+        self.assertNotExists("x")
+        self.mc.set("x", 0, 19, "somevalue")
+        self.assertGet((19, "somevalue"), self.mc.get("x"))
+        self.assertEquals({}, self.mc.getMulti(["y"]))
+        self.mc.add("y", 0, 19, "why")
+        self.assertGet((19, "why"), self.mc.getMulti(["y"])["y"])
+        self.assertNotExists("z")
+        self.mc.incr("z", init=3)
+        self.assertEquals(3, int(self.mc.get("z")[2]))
+
     def testTimeBombedFlush(self):
         """Test a flush with a time bomb."""
         val, cas, something=self.mc.set("x", 5, 19, "some")
         self.mc.flush(2)
         self.assertGet((19, 'some'), self.mc.get("x"))
-        time.sleep(2.1)
+        self.sleep(2.1)
         self.assertNotExists('x')
 
+class IndexedComplianceTest(ComplianceTest):
+    """The compliance tests against a backend keeping a prefix index."""
+
+    backendArgs={'prefixIndex': True}
+
+    def setUp(self):
+        if not inProcessServer():
+            self.skipTest("Only meaningful for the in-process server")
+        ComplianceTest.setUp(self)
+
 if __name__ == '__main__':
     unittest.main()
@@ -9,19 +9,65 @@ import asyncore
 import random
 import string
 import socket
-import struct
+import os
+import stat
 import time
 import hmac
 import heapq
+import pstats
+import cProfile
+import cStringIO
+import collections
 
 import memcacheConstants
+import memcacheCodec
+import memcacheHotKeys
+import memcacheCapture
+import memcacheTrace
 
-from memcacheConstants import MIN_RECV_PACKET, REQ_PKT_FMT, RES_PKT_FMT
-from memcacheConstants import INCRDECR_RES_FMT
-from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE, EXTRA_HDR_FMTS
+from memcacheTrace import DEBUG, INFO, WARNING
+
+from memcacheConstants import MIN_RECV_PACKET, INCRDECR_RES_FMT
+from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE
+
+GET_RES=memcacheCodec.getStruct(memcacheConstants.GET_RES_FMT)
+DELETE_PREFIX_RES=memcacheCodec.getStruct(
+    memcacheConstants.DELETE_PREFIX_RES_FMT)
+INCRDECR_RES=memcacheCodec.getStruct(INCRDECR_RES_FMT)
 
 VERSION="1.0"
 
+# Room for a response header in a write buffer
+RES_HDR_SPACE='\0' * MIN_RECV_PACKET
+
+class SlowLog(object):
+    """The most recent commands that took at least threshold seconds."""
+
+    def __init__(self, threshold=0.01, size=128):
+        self.threshold=threshold
+        self.entries=collections.deque(maxlen=size)
+        # Slow commands seen in all
+        self.total=0
+
+    def record(self, when, duration, cmd, key, bodylen, responselen, conn):
+        self.total += 1
+        self.entries.append((when, duration, cmd, key, bodylen, responselen,
+                             conn))
+
+    def stats(self):
+        rv={'threshold_us': int(self.threshold * 1e6), 'total': self.total}
+        for i, e in enumerate(reversed(self.entries)):
+            when, duration, cmd, key, bodylen, responselen, conn=e
+            rv.update({'%d:time' % i: "%.6f" % when,
+                       '%d:duration_us' % i: int(duration * 1e6),
+                       '%d:cmd' % i: memcacheConstants.COMMAND_NAMES.get(
+                           cmd, "0x%x" % cmd),
+                       '%d:key' % i: key,
+                       '%d:body' % i: bodylen,
+                       '%d:response' % i: responselen,
+                       '%d:conn' % i: conn})
+        return rv
+
 class BaseBackend(object):
     """Higher-level backend (processes commands and stuff)."""
 
@@ -30,12 +76,16 @@ class BaseBackend(object):
     CMDS={
         memcacheConstants.CMD_GET: 'handle_get',
         memcacheConstants.CMD_GETQ: 'handle_getq',
+        memcacheConstants.CMD_GETK: 'handle_getk',
+        memcacheConstants.CMD_GETKQ: 'handle_getkq',
         memcacheConstants.CMD_SET: 'handle_set',
         memcacheConstants.CMD_ADD: 'handle_add',
         memcacheConstants.CMD_REPLACE: 'handle_replace',
         memcacheConstants.CMD_DELETE: 'handle_delete',
         memcacheConstants.CMD_INCR: 'handle_incr',
         memcacheConstants.CMD_DECR: 'handle_decr',
+        memcacheConstants.CMD_INCRQ: 'handle_incrq',
+        memcacheConstants.CMD_DECRQ: 'handle_decrq',
         memcacheConstants.CMD_QUIT: 'handle_quit',
         memcacheConstants.CMD_FLUSH: 'handle_flush',
         memcacheConstants.CMD_NOOP: 'handle_noop',
@@ -45,64 +95,319 @@ class BaseBackend(object):
         memcacheConstants.CMD_SASL_LIST_MECHS: 'handle_sasl_mechs',
         memcacheConstants.CMD_SASL_AUTH: 'handle_sasl_auth',
         memcacheConstants.CMD_SASL_STEP: 'handle_sasl_step',
+        memcacheConstants.CMD_STAT: 'handle_stat',
+        memcacheConstants.CMD_DELETE_PREFIX: 'handle_delete_prefix',
         }
 
-    def __init__(self):
+    # Stat groups to method names (each returning a dict of stats).
+    STATS={
+        '': 'stats_general',
+        'hotkeys': 'stats_hotkeys',
+        'slowlog': 'stats_slowlog',
+        'slowlog reset': 'stats_slowlog_reset',
+        'profile start': 'stats_profile_start',
+        'profile stop': 'stats_profile_stop',
+        'trace': 'stats_trace',
+        'trace reset': 'stats_trace_reset',
+        'trace debug': 'stats_trace_debug',
+        'trace info': 'stats_trace_info',
+        }
+
+    # Number of functions in a profile report
+    PROFILE_LINES=40
+
+    # Commands counted as reads and writes for hot key tracking.
+    READ_CMDS=frozenset([memcacheConstants.CMD_GET, memcacheConstants.CMD_GETQ,
+        memcacheConstants.CMD_GETK, memcacheConstants.CMD_GETKQ])
+    WRITE_CMDS=frozenset([memcacheConstants.CMD_SET, memcacheConstants.CMD_ADD,
+        memcacheConstants.CMD_REPLACE, memcacheConstants.CMD_DELETE,
+        memcacheConstants.CMD_INCR, memcacheConstants.CMD_DECR,
+        memcacheConstants.CMD_INCRQ, memcacheConstants.CMD_DECRQ,
+        memcacheConstants.CMD_APPEND, memcacheConstants.CMD_PREPEND])
+
+    # Fraction of keyed commands sampled for hot key tracking.
+    HOT_KEY_SAMPLE_RATE=0.1
+
+    def __init__(self, clock=time.time):
         self.handlers={}
         self.sched=[]
+        # Where the current time comes from (for expiry, delayed jobs, etc.)
+        self.clock=clock
+        self.datatype=memcacheConstants.DATATYPE_RAW
+        self.started=clock()
+        self.hotReads=memcacheHotKeys.HotKeyTracker(
+            sampleRate=self.HOT_KEY_SAMPLE_RATE, clock=clock)
+        self.hotWrites=memcacheHotKeys.HotKeyTracker(
+            sampleRate=self.HOT_KEY_SAMPLE_RATE, clock=clock)
+        # Filled in by the channel, which knows how long commands take
+        self.slowlog=SlowLog()
+        self.profiler=None
+        self.trace=memcacheTrace.TraceBuffer(clock=clock)
 
         for id, method in self.CMDS.iteritems():
             self.handlers[id]=getattr(self, method, self.handle_unknown)
 
-    def _splitKeys(self, fmt, keylen, data):
-        """Split the given data into the headers as specified in the given
-        format, the key, and the data.
+    def _splitKeys(self, cmd, keylen, data):
+        """Split the given data into the headers as specified by the extras
+        layout of the given command, the key, and the data.
 
         Return (hdrTuple, key, data)"""
-        hdrSize=struct.calcsize(fmt)
-        assert hdrSize <= len(data), "Data too short for " + fmt + ': ' + `data`
-        hdr=struct.unpack(fmt, data[:hdrSize])
-        assert len(data) >= hdrSize + keylen
-        key=data[hdrSize:keylen+hdrSize]
-        assert len(key) == keylen, "len(%s) == %d, expected %d" \
-            % (key, len(key), keylen)
-        val=data[keylen+hdrSize:]
-        return hdr, key, val
+        return memcacheCodec.splitKeys(cmd, keylen, data)
 
     def _error(self, which, msg):
         return which, 0, msg
 
-    def processCommand(self, cmd, keylen, vb, cas, data):
+    def _response(self, cas, value, key='', extras='', dtype=0, status=0):
+        """Build a response carrying its own key, extras and datatype.
+
+        Handlers returning the short (status, cas, data) form send data as
+        the value alone."""
+        return status, cas, value, key, extras, dtype
+
+    def processCommand(self, cmd, keylen, vb, cas, data,
+                       datatype=memcacheConstants.DATATYPE_RAW):
         """Entry point for command processing.  Lower level protocol
         implementations deliver values here."""
+        hdrs, key, val=self._splitKeys(cmd, keylen, data)
+        return self._dispatch(cmd, hdrs, key, cas, val, datatype)
+
+    def processPacket(self, pkt):
+        """Process the request in a memcacheCodec.PacketView, copying out
+        only its key and value."""
+        return self._dispatch(pkt.opcode, pkt.extraHeaders(),
+                              pkt.key.tobytes(), pkt.cas, pkt.value.tobytes(),
+                              pkt.datatype)
 
-        now=time.time()
+    def _dispatch(self, cmd, hdrs, key, cas, val, datatype):
+        self.datatype=datatype
+
+        now=self.clock()
         while self.sched and self.sched[0][0] <= now:
-            print "Running delayed job."
+            self.trace.record('sched', INFO, 'running delayed job')
             heapq.heappop(self.sched)[1]()
 
-        hdrs, key, val=self._splitKeys(EXTRA_HDR_FMTS.get(cmd, ''),
-            keylen, data)
+        # Values must be raw or compressed with a codec available here.
+        if datatype and not memcacheCodec.isCompressed(datatype):
+            return self._error(memcacheConstants.ERR_EINVAL,
+                               'Unsupported datatype 0x%x' % datatype)
+
+        if cmd in self.READ_CMDS:
+            self.hotReads.record(key)
+        elif cmd in self.WRITE_CMDS:
+            self.hotWrites.record(key)
 
         return self.handlers.get(cmd, self.handle_unknown)(cmd, hdrs, key,
             cas, val)
 
     def handle_noop(self, cmd, hdrs, key, cas, data):
         """Handle a noop"""
-        print "Noop"
+        self.trace.record('cmd', DEBUG, 'noop')
         return 0, 0, ''
 
+    def handle_stat(self, cmd, hdrs, key, cas, data):
+        """Return one response per stat in the requested group, terminated
+        by an empty one."""
+        method=self.STATS.get(key)
+        if method is None:
+            return self._error(memcacheConstants.ERR_NOT_FOUND,
+                               'Unknown stat group')
+        rv=[self._response(0, str(v), k)
+            for k, v in sorted(getattr(self, method)().iteritems())]
+        rv.append(self._response(0, ''))
+        return rv
+
+    def stats_general(self):
+        now=self.clock()
+        return {'pid': os.getpid(), 'version': VERSION,
+                'time': int(now), 'uptime': int(now - self.started)}
+
+    def stats_hotkeys(self):
+        rv=self.hotReads.stats('read')
+        rv.update(self.hotWrites.stats('write'))
+        return rv
+
+    def stats_slowlog(self):
+        return self.slowlog.stats()
+
+    def stats_slowlog_reset(self):
+        self.slowlog=SlowLog(self.slowlog.threshold,
+                             self.slowlog.entries.maxlen)
+        return {}
+
+    def stats_profile_start(self):
+        """Profile everything the server does until profiling is stopped."""
+        if self.profiler is None:
+            self.profiler=cProfile.Profile()
+            self.profiler.enable()
+        return {'status': 'running'}
+
+    def stats_profile_stop(self):
+        """Stop profiling and report where the time went."""
+        if self.profiler is None:
+            return {'status': 'stopped'}
+        self.profiler.disable()
+        out=cStringIO.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats(
+            'cumulative').print_stats(self.PROFILE_LINES)
+        self.profiler=None
+        return {'status': 'stopped', 'report': out.getvalue()}
+
+    def stats_trace(self):
+        return self.trace.stats()
+
+    def stats_trace_reset(self):
+        self.trace.clear()
+        return {}
+
+    def stats_trace_debug(self):
+        """Trace everything (until trace info)."""
+        self.trace.setLevel(DEBUG)
+        return {'level': 'debug'}
+
+    def stats_trace_info(self):
+        self.trace.setLevel(INFO)
+        return {'level': 'info'}
+
     def handle_unknown(self, cmd, hdrs, key, cas, data):
         """invoked for any unknown command."""
         return self._error(memcacheConstants.ERR_UNKNOWN_CMD,
             "The command %d is unknown" % cmd)
 
+class ChunkedValue(object):
+    """A value built by appending and prepending, kept as a list of chunks.
+
+    Small additions are collected at either end and only joined into a
+    chunk once they add up to COMPACT_SIZE, so each byte is copied a
+    constant number of times no matter how the value was built.  The whole
+    value is only flattened when it's needed as a string."""
+
+    # Size at which pending small additions are joined into a chunk.
+    COMPACT_SIZE=65536
+
+    def __init__(self, data=''):
+        self.chunks=collections.deque([data])
+        # Small additions not yet joined (head is in reverse order)
+        self.head=[]
+        self.headSize=0
+        self.tail=[]
+        self.tailSize=0
+        self.size=len(data)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        self.tail.append(data)
+        self.tailSize += len(data)
+        self.size += len(data)
+        if self.tailSize >= self.COMPACT_SIZE:
+            self.chunks.append(''.join(self.tail))
+            self.tail=[]
+            self.tailSize=0
+
+    def prepend(self, data):
+        self.head.append(data)
+        self.headSize += len(data)
+        self.size += len(data)
+        if self.headSize >= self.COMPACT_SIZE:
+            self.chunks.appendleft(''.join(reversed(self.head)))
+            self.head=[]
+            self.headSize=0
+
+    def __iter__(self):
+        """Iterate the value chunk by chunk without flattening it."""
+        for c in reversed(self.head):
+            yield c
+        for c in self.chunks:
+            yield c
+        for c in self.tail:
+            yield c
+
+    def __str__(self):
+        if self.head or self.tail or len(self.chunks) > 1:
+            self.chunks=collections.deque([''.join(self)])
+            self.head=[]
+            self.headSize=0
+            self.tail=[]
+            self.tailSize=0
+        return self.chunks[0]
+
+class PrefixIndex(object):
+    """A character trie of keys for finding every key under a prefix.
+
+    Each node is [children, number of keys at or below it, is a key]."""
+
+    def __init__(self):
+        self.root=[{}, 0, False]
+
+    def __find(self, key):
+        node=self.root
+        for c in key:
+            node=node[0].get(c)
+            if node is None:
+                break
+        return node
+
+    def __contains__(self, key):
+        node=self.__find(key)
+        return node is not None and node[2]
+
+    def add(self, key):
+        if key in self:
+            return
+        node=self.root
+        node[1] += 1
+        for c in key:
+            node=node[0].setdefault(c, [{}, 0, False])
+            node[1] += 1
+        node[2]=True
+
+    def remove(self, key):
+        if key not in self:
+            return
+        node=self.root
+        node[1] -= 1
+        for c in key:
+            child=node[0][c]
+            child[1] -= 1
+            if not child[1]:
+                # Nothing else lives down here.
+                del node[0][c]
+                return
+            node=child
+        node[2]=False
+
+    def count(self, prefix):
+        """Number of keys starting with prefix."""
+        node=self.__find(prefix)
+        return node[1] if node else 0
+
+    def keys(self, prefix):
+        """All keys starting with prefix."""
+        rv=[]
+        node=self.__find(prefix)
+        todo=[(prefix, node)] if node else []
+        while todo:
+            k, node=todo.pop()
+            if node[2]:
+                rv.append(k)
+            todo.extend((k + c, n) for c, n in node[0].iteritems())
+        return rv
+
 class DictBackend(BaseBackend):
     """Sample backend implementation with a non-expiring dict."""
 
-    def __init__(self):
-        super(DictBackend, self).__init__()
+    # Values growing past this size through append/prepend are kept as a
+    # ChunkedValue rather than being copied on every change.
+    CHUNK_THRESHOLD=4096
+
+    def __init__(self, clock=time.time, prefixIndex=False):
+        """With prefixIndex, every key is also kept in a PrefixIndex so
+        prefix deletes and counts don't have to scan all of storage."""
+        super(DictBackend, self).__init__(clock)
         self.storage={}
+        self.index=PrefixIndex() if prefixIndex else None
+        self.__resetTotals()
         self.held_keys={}
         self.challenge = ''.join(random.sample(string.ascii_letters
                                                + string.digits, 32))
@@ -110,26 +415,43 @@ class DictBackend(BaseBackend):
     def __lookup(self, key):
         rv=self.storage.get(key, None)
         if rv:
-            now=time.time()
+            now=self.clock()
             if now >= rv[1]:
-                print key, "expired"
-                del self.storage[key]
+                self.trace.record('storage', DEBUG, 'expired', key)
+                self.__remove(key)
                 rv=None
         else:
-            print "Miss looking up", key
+            self.trace.record('storage', DEBUG, 'miss', key)
         return rv
 
-    def handle_get(self, cmd, hdrs, key, cas, data):
+    def __value(self, val):
+        """The uncompressed value of a stored item."""
+        if memcacheCodec.isCompressed(val[3]):
+            return memcacheCodec.decompress(val[3], val[2])
+        return str(val[2])
+
+    def __get(self, key, withKey):
         val=self.__lookup(key)
+        rkey=key if withKey else ''
         if val:
-            rv = 0, id(val), struct.pack(
-                memcacheConstants.GET_RES_FMT, val[0]) + str(val[2])
+            rv=self._response(id(val), str(val[2]), rkey,
+                              GET_RES.pack(val[0]), val[3])
+        elif withKey:
+            # Like memcached, a GETK miss carries just the key.
+            rv=self._response(0, '', key,
+                              status=memcacheConstants.ERR_NOT_FOUND)
         else:
             rv=self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
         return rv
 
+    def handle_get(self, cmd, hdrs, key, cas, data):
+        return self.__get(key, False)
+
+    def handle_getk(self, cmd, hdrs, key, cas, data):
+        return self.__get(key, True)
+
     def handle_set(self, cmd, hdrs, key, cas, data):
-        print "Handling a set with", hdrs
+        self.trace.record('cmd', DEBUG, 'set', key, hdrs)
         val=self.__lookup(key)
         exp, flags=hdrs
         def f(val):
@@ -139,7 +461,13 @@ class DictBackend(BaseBackend):
     def handle_getq(self, cmd, hdrs, key, cas, data):
         rv=self.handle_get(cmd, hdrs, key, cas, data)
         if rv[0] == memcacheConstants.ERR_NOT_FOUND:
-            print "Swallowing miss"
+            self.trace.record('cmd', DEBUG, 'swallowed miss', key)
+            rv = None
+        return rv
+
+    def handle_getkq(self, cmd, hdrs, key, cas, data):
+        rv=self.handle_getk(cmd, hdrs, key, cas, data)
+        if rv[0] == memcacheConstants.ERR_NOT_FOUND:
             rv = None
         return rv
 
@@ -148,8 +476,10 @@ class DictBackend(BaseBackend):
         # If it's going to expire soon, tell it to wait a while.
         if exp == 0:
             exp=float(2 ** 31)
-        self.storage[key]=(hdrs[0], time.time() + exp, data)
-        print "Stored", self.storage[key], "in", key
+        # Compressed values are stored as they arrived.
+        self.__store(key, (hdrs[0], self.clock() + exp, data, self.datatype))
+        self.trace.record('storage', DEBUG, 'stored', key, hdrs[0], exp,
+                          self.datatype, len(data))
         if key in self.held_keys:
             del self.held_keys[key]
         return 0, id(self.storage[key]), ''
@@ -158,20 +488,24 @@ class DictBackend(BaseBackend):
         amount, initial, expiration=hdrs
         rv=self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
         val=self.storage.get(key, None)
-        print "Mutating %s, hdrs=%s, val=%s %s" % (key, `hdrs`, `val`,
-            multiplier)
+        self.trace.record('cmd', DEBUG, 'mutating', key, hdrs, multiplier)
         if val:
-            val = (val[0], val[1], max(0, long(val[2]) + (multiplier * amount)))
-            self.storage[key]=val
+            val = (val[0], val[1],
+                   max(0, long(self.__value(val)) + (multiplier * amount)),
+                   memcacheConstants.DATATYPE_RAW)
+            self.__store(key, val)
             rv=0, id(val), str(val[2])
         else:
             if expiration != memcacheConstants.INCRDECR_SPECIAL:
-                self.storage[key]=(0, time.time() + expiration, initial)
+                # Like sets, a zero expiration means never.
+                if expiration == 0:
+                    expiration=float(2 ** 31)
+                self.__store(key, (0, self.clock() + expiration, initial,
+                                   memcacheConstants.DATATYPE_RAW))
                 rv=0, id(self.storage[key]), str(initial)
         if rv[0] == 0:
-            rv = rv[0], rv[1], struct.pack(
-                memcacheConstants.INCRDECR_RES_FMT, long(rv[2]))
-        print "Returning", rv
+            rv = rv[0], rv[1], INCRDECR_RES.pack(long(rv[2]))
+        self.trace.record('cmd', DEBUG, 'mutated', key, rv[0])
         return rv
 
     def handle_incr(self, cmd, hdrs, key, cas, data):
@@ -180,12 +514,63 @@ class DictBackend(BaseBackend):
     def handle_decr(self, cmd, hdrs, key, cas, data):
         return self.__mutation(cmd, hdrs, key, data, -1)
 
+    def handle_incrq(self, cmd, hdrs, key, cas, data):
+        rv=self.__mutation(cmd, hdrs, key, data, 1)
+        if rv[0] == 0:
+            rv=None
+        return rv
+
+    def handle_decrq(self, cmd, hdrs, key, cas, data):
+        rv=self.__mutation(cmd, hdrs, key, data, -1)
+        if rv[0] == 0:
+            rv=None
+        return rv
+
+    def __store(self, key, item):
+        old=self.storage.get(key)
+        if old is not None:
+            self.__account(key, old, -1)
+        self.storage[key]=item
+        self.__account(key, item, 1)
+        if self.index is not None:
+            self.index.add(key)
+
+    def __remove(self, key):
+        self.__account(key, self.storage.pop(key), -1)
+        if self.index is not None:
+            self.index.remove(key)
+
+    def __resetTotals(self):
+        self.storedBytes=0
+        self.compressedItems=0
+        self.compressedBytes=0
+        self.rawBytes=0
+        # Uncompressed sizes of compressed items, found once when stored
+        self.rawSizes={}
+
+    def __account(self, key, item, sign):
+        """Add an item to (sign 1) or take it from (sign -1) the storage
+        totals reported by stats."""
+        data=item[2]
+        if isinstance(data, (int, long)):
+            data=str(data)
+        self.storedBytes += sign * len(data)
+        if memcacheCodec.isCompressed(item[3]):
+            if sign > 0:
+                raw=self.rawSizes[key]=len(self.__value(item))
+            else:
+                raw=self.rawSizes.pop(key)
+            self.compressedItems += sign
+            self.compressedBytes += sign * len(data)
+            self.rawBytes += sign * raw
+
     def __has_hold(self, key):
         rv=False
-        now=time.time()
-        print "Looking for hold of", key, "in", self.held_keys, "as of", now
+        now=self.clock()
         if key in self.held_keys:
-            if time.time() > self.held_keys[key]:
+            self.trace.record('storage', DEBUG, 'held', key,
+                              self.held_keys[key], now)
+            if now > self.held_keys[key]:
                 del self.held_keys[key]
             else:
                 rv=True
@@ -207,10 +592,13 @@ class DictBackend(BaseBackend):
         timebomb_delay=hdrs[0]
         def f():
             self.storage.clear()
+            self.__resetTotals()
+            if self.index is not None:
+                self.index=PrefixIndex()
             self.held_keys.clear()
-            print "Flushed"
+            self.trace.record('storage', INFO, 'flushed')
         if timebomb_delay:
-            heapq.heappush(self.sched, (time.time() + timebomb_delay, f))
+            heapq.heappush(self.sched, (self.clock() + timebomb_delay, f))
         else:
             f()
         return 0, 0, ''
@@ -219,15 +607,49 @@ class DictBackend(BaseBackend):
         def f(val):
             rv=self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
             if val:
-                del self.storage[key]
+                self.__remove(key)
                 rv = 0, 0, ''
-            print "Deleted", key
+            self.trace.record('storage', DEBUG, 'deleted', key, rv[0])
             return rv
         return self._withCAS(key, cas, f)
 
+    def handle_delete_prefix(self, cmd, hdrs, key, cas, data):
+        countOnly=hdrs[0] & memcacheConstants.DELETE_PREFIX_COUNT_ONLY
+        if self.index is not None:
+            keys=self.index.keys(key)
+        else:
+            keys=[k for k in self.storage if k.startswith(key)]
+        # Expired items found on the way are reaped rather than counted.
+        now=self.clock()
+        live=[]
+        for k in keys:
+            if now >= self.storage[k][1]:
+                self.__remove(k)
+            else:
+                live.append(k)
+        keys=live
+        if not countOnly:
+            for k in keys:
+                self.__remove(k)
+            self.trace.record('storage', INFO, 'deleted prefix', key,
+                              len(keys))
+        return self._response(0, DELETE_PREFIX_RES.pack(len(keys)))
+
     def handle_version(self, cmd, hdrs, key, cas, data):
         return 0, 0, "Python test memcached server %s" % VERSION
 
+    def stats_general(self):
+        rv=super(DictBackend, self).stats_general()
+        rv.update({'curr_items': len(self.storage),
+                   'bytes': self.storedBytes,
+                   'compressed_items': self.compressedItems,
+                   'compressed_bytes': self.compressedBytes,
+                   'compressed_raw_bytes': self.rawBytes,
+                   'compression_ratio': "%.2f" % (
+                       float(self.rawBytes) / self.compressedBytes
+                       if self.compressedBytes else 1.0)})
+        return rv
+
     def _withCAS(self, key, cas, f):
         val=self.storage.get(key, None)
         if cas == 0 or (val and cas == id(val)):
@@ -238,17 +660,36 @@ class DictBackend(BaseBackend):
             rv = self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
         return rv
 
-    def handle_prepend(self, cmd, hdrs, key, cas, data):
+    def __cat(self, key, cas, data, prepend):
         def f(val):
-            self.storage[key]=(val[0], val[1], data + val[2])
+            # The value may be grown in place below.
+            self.__account(key, val, -1)
+            current=val[2]
+            if not isinstance(current, ChunkedValue):
+                current=self.__value(val)
+                if len(current) + len(data) >= self.CHUNK_THRESHOLD:
+                    current=ChunkedValue(current)
+            if isinstance(current, ChunkedValue):
+                if prepend:
+                    current.prepend(data)
+                else:
+                    current.append(data)
+            elif prepend:
+                current=data + current
+            else:
+                current=current + data
+            # A new tuple for the new CAS even if the value changed in place.
+            self.storage[key]=(val[0], val[1], current,
+                               memcacheConstants.DATATYPE_RAW)
+            self.__account(key, self.storage[key], 1)
             return 0, id(self.storage[key]), ''
         return self._withCAS(key, cas, f)
 
+    def handle_prepend(self, cmd, hdrs, key, cas, data):
+        return self.__cat(key, cas, data, True)
+
     def handle_append(self, cmd, hdrs, key, cas, data):
-        def f(val):
-            self.storage[key]=(val[0], val[1], val[2] + data)
-            return 0, id(self.storage[key]), ''
-        return self._withCAS(key, cas, f)
+        return self.__cat(key, cas, data, False)
 
     def handle_sasl_mechs(self, cmd, hdrs, key, cas, data):
         return 0, 0, 'PLAIN CRAM-MD5'
@@ -260,24 +701,25 @@ class DictBackend(BaseBackend):
         expected = hmac.HMAC('testpass', self.challenge).hexdigest()
 
         if u == 'testuser' and resp == expected:
-            print "Successful CRAM-MD5 auth."
+            self.trace.record('auth', INFO, 'CRAM-MD5 succeeded', u)
             return 0, 0, 'OK'
         else:
-            print "Errored a CRAM-MD5 auth."
+            self.trace.record('auth', WARNING, 'CRAM-MD5 failed', u)
             return self._error(memcacheConstants.ERR_AUTH, 'Auth error.')
 
     def _handle_sasl_auth_plain(self, data):
         foruser, user, passwd = data.split("\0")
         if user == 'testuser' and passwd == 'testpass':
-            print "Successful plain auth"
+            self.trace.record('auth', INFO, 'PLAIN succeeded', user)
             return 0, 0, "OK"
         else:
-            print "Bad username/password:  %s/%s" % (user, passwd)
+            self.trace.record('auth', WARNING, 'PLAIN failed', user)
             return self._error(memcacheConstants.ERR_AUTH, 'Auth error.')
 
     def _handle_sasl_auth_cram_md5(self, data):
         assert data == ''
-        print "Issuing %s as a CRAM-MD5 challenge." % self.challenge
+        self.trace.record('auth', DEBUG, 'CRAM-MD5 challenge',
+                          self.challenge)
         return memcacheConstants.ERR_AUTH_CONTINUE, 0, self.challenge
 
     def handle_sasl_auth(self, cmd, hdrs, key, cas, data):
@@ -288,7 +730,7 @@ class DictBackend(BaseBackend):
         elif mech == 'CRAM-MD5':
             return self._handle_sasl_auth_cram_md5(data)
         else:
-            print "Unhandled auth type:  %s" % mech
+            self.trace.record('auth', WARNING, 'unknown mechanism', mech)
             return self._error(memcacheConstants.ERR_AUTH, 'Auth error.')
 
 class MemcachedBinaryChannel(asyncore.dispatcher):
@@ -297,61 +739,123 @@ class MemcachedBinaryChannel(asyncore.dispatcher):
     # Receive buffer size
     BUFFER_SIZE = 4096
 
-    def __init__(self, channel, backend, wbuf=""):
-        asyncore.dispatcher.__init__(self, channel)
+    def __init__(self, channel, backend, wbuf='', map=None, capture=None):
+        """With a memcacheCapture.CaptureWriter, every request and response
+        on this connection is recorded."""
+        asyncore.dispatcher.__init__(self, channel, map)
         self.log_info("New bin connection from %s" % str(self.addr))
         self.backend=backend
-        self.wbuf=wbuf
-        self.rbuf=""
-
-    def __hasEnoughBytes(self):
-        rv=False
-        if len(self.rbuf) >= MIN_RECV_PACKET:
-            magic, cmd, keylen, extralen, datatype, vb, remaining, opaque, cas=\
-                struct.unpack(REQ_PKT_FMT, self.rbuf[:MIN_RECV_PACKET])
-            rv = len(self.rbuf) - MIN_RECV_PACKET >= remaining
+        self.capture=capture
+        if capture:
+            self.captureId=capture.newConnection()
+        self.wbuf=bytearray(wbuf)
+        # How much of wbuf has already been sent
+        self.wpos=0
+        self.rbuf=bytearray()
+
+    def processPacket(self, pkt):
+        start=time.time()
+        rv=self.backend.processPacket(pkt)
+        duration=time.time() - start
+        slowlog=self.backend.slowlog
+        if duration >= slowlog.threshold:
+            slowlog.record(start, duration, pkt.opcode, pkt.key.tobytes(),
+                           pkt.bodylen, self.responseSize(rv), self.peer())
         return rv
 
-    def processCommand(self, cmd, keylen, vb, extralen, cas, data):
-        return self.backend.processCommand(cmd, keylen, vb, cas, data)
+    def responseSize(self, cmdVal):
+        """Body size of the response(s) to a command."""
+        if not cmdVal:
+            return 0
+        if isinstance(cmdVal, list):
+            return sum(self.responseSize(v) for v in cmdVal)
+        return sum(len(part) for part in cmdVal[2:5])
+
+    def peer(self):
+        if isinstance(self.addr, tuple):
+            return "%s:%d" % self.addr[:2]
+        return self.addr or 'unix'
+
+    def queueResponse(self, pkt, cmdVal):
+        """Queue a response (or a list of them) to the given request."""
+        if isinstance(cmdVal, list):
+            for v in cmdVal:
+                self.queueResponse(pkt, v)
+            return
+        if len(cmdVal) == 6:
+            status, cas, value, key, extras, dtype = cmdVal
+            self.queue(pkt.opcode, status, pkt.opaque, cas, (extras, key,
+                value), len(key), len(extras), dtype)
+            return
+        try:
+            status, cas, response = cmdVal
+        except ValueError:
+            print "Got", cmdVal
+            raise
+        self.queue(pkt.opcode, status, pkt.opaque, cas, (response,))
+
+    def queue(self, cmd, status, opaque, cas, parts, keylen=0, extralen=0,
+              dtype=0):
+        """Queue a response whose body is the given parts (extras, key,
+        value) to be written to the client.
+
+        The header is packed straight into the write buffer."""
+        if self.wpos:
+            del self.wbuf[:self.wpos]
+            self.wpos=0
+        start=len(self.wbuf)
+        self.wbuf.extend(RES_HDR_SPACE)
+        memcacheCodec.packHeaderInto(self.wbuf, start, RES_MAGIC_BYTE, cmd,
+            keylen, extralen, dtype, status, sum(len(p) for p in parts),
+            opaque, cas)
+        for p in parts:
+            self.wbuf.extend(p)
+        if self.capture:
+            self.capture.write(memcacheCapture.DIR_RESPONSE, self.captureId,
+                               str(self.wbuf[start:]))
+
+    def recvSize(self):
+        """How much to ask for on the next read.
+
+        The whole remainder of a large packet is read at once so big
+        bodies don't trickle in BUFFER_SIZE at a time."""
+        n=memcacheCodec.packetLength(self.rbuf)
+        if n is None:
+            return self.BUFFER_SIZE
+        return max(self.BUFFER_SIZE, n - len(self.rbuf))
 
     def handle_read(self):
-        self.rbuf += self.recv(self.BUFFER_SIZE)
-        while self.__hasEnoughBytes():
-            magic, cmd, keylen, extralen, datatype, vb, remaining, opaque, cas=\
-                struct.unpack(REQ_PKT_FMT, self.rbuf[:MIN_RECV_PACKET])
-            assert magic == REQ_MAGIC_BYTE
-            assert keylen <= remaining, "Keylen is too big: %d > %d" \
-                % (keylen, remaining)
+        self.rbuf.extend(self.recv(self.recvSize()))
+        consumed=0
+        for pkt in memcacheCodec.iterPackets(self.rbuf):
+            consumed += pkt.size
+            cmd, keylen, extralen=pkt.opcode, pkt.keylen, pkt.extralen
+            assert pkt.magic == REQ_MAGIC_BYTE
+            assert keylen <= pkt.bodylen, "Keylen is too big: %d > %d" \
+                % (keylen, pkt.bodylen)
             assert extralen == memcacheConstants.EXTRA_HDR_SIZES.get(cmd, 0), \
                 "Extralen is too large for cmd 0x%x: %d" % (cmd, extralen)
-            # Grab the data section of this request
-            data=self.rbuf[MIN_RECV_PACKET:MIN_RECV_PACKET+remaining]
-            assert len(data) == remaining
-            # Remove this request from the read buffer
-            self.rbuf=self.rbuf[MIN_RECV_PACKET+remaining:]
+            if self.capture:
+                self.capture.write(memcacheCapture.DIR_REQUEST,
+                                   self.captureId, pkt.raw.tobytes())
             # Process the command
-            cmdVal = self.processCommand(cmd, keylen, vb, extralen, cas, data)
+            cmdVal = self.processPacket(pkt)
             # Queue the response to the client if applicable.
             if cmdVal:
-                try:
-                    status, cas, response = cmdVal
-                except ValueError:
-                    print "Got", cmdVal
-                    raise
-                dtype=0
-                extralen=memcacheConstants.EXTRA_HDR_SIZES.get(cmd, 0)
-                self.wbuf += struct.pack(RES_PKT_FMT,
-                    RES_MAGIC_BYTE, cmd, keylen,
-                    extralen, dtype, status,
-                    len(response), opaque, cas) + response
+                self.queueResponse(pkt, cmdVal)
+        # Remove the processed requests from the read buffer
+        if consumed:
+            del self.rbuf[:consumed]
 
     def writable(self):
-        return self.wbuf
+        return len(self.wbuf) > self.wpos
 
     def handle_write(self):
-        sent = self.send(self.wbuf)
-        self.wbuf = self.wbuf[sent:]
+        # Send from an offset rather than re-slicing large responses.
+        self.wpos += self.send(buffer(self.wbuf, self.wpos))
+        if self.wpos == len(self.wbuf):
+            del self.wbuf[:]
+            self.wpos=0
 
     def handle_close(self):
         self.log_info("Disconnected from %s" % str(self.addr))
@@ -359,26 +863,84 @@ class MemcachedBinaryChannel(asyncore.dispatcher):
 
 class MemcachedServer(asyncore.dispatcher):
     """A memcached server."""
-    def __init__(self, backend, handler, port=11211):
-        asyncore.dispatcher.__init__(self)
+    def __init__(self, backend, handler, port=11211, map=None, path=None,
+                 mode=None, capture=None):
+        """Listen on the given port (0 picks a free one, see self.port), or
+        on a unix domain socket at path with the given permission mode.
+
+        A separate asyncore map lets a server run its own loop, e.g. in a
+        thread within a test process.  Traffic on every connection is
+        recorded to capture (a memcacheCapture.CaptureWriter) if given."""
+        asyncore.dispatcher.__init__(self, map=map)
 
         self.handler=handler
         self.backend=backend
-
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind(("", port))
-        self.listen(5)
-        self.log_info("Listening on %d" % port)
+        self.capture=capture
+
+        self.path=path
+        if path:
+            self.port=None
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # Clear out a socket left behind by a previous run.
+            if os.path.exists(path) \
+                    and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+            if mode is None:
+                self.bind(path)
+            else:
+                # Nobody may connect before the mode is in place.
+                umask=os.umask(0777)
+                try:
+                    self.bind(path)
+                finally:
+                    os.umask(umask)
+                os.chmod(path, mode)
+            self.listen(5)
+            self.log_info("Listening on %s" % path)
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind(("", port))
+            self.port=self.getsockname()[1]
+            self.listen(5)
+            self.log_info("Listening on %d" % self.port)
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
 
     def handle_accept(self):
         channel, addr = self.accept()
-        self.handler(channel, self.backend)
+        self.handler(channel, self.backend, map=self._map,
+                     capture=self.capture)
 
 if __name__ == '__main__':
     port = 11211
+    path = None
+    mode = None
+    capture = None
     import sys
-    if sys.argv > 1:
-        port = int(sys.argv[1])
-    server = MemcachedServer(DictBackend(), MemcachedBinaryChannel, port=port)
-    asyncore.loop()
+    # usage: testServer.py [-w capture file] [port | socket path [octal mode]]
+    # SIGUSR1 dumps the trace buffer to stderr.
+    if sys.argv[1:2] == ['-w']:
+        capture = memcacheCapture.CaptureWriter(open(sys.argv[2], 'wb'))
+        del sys.argv[1:3]
+    if len(sys.argv) > 1:
+        if sys.argv[1].isdigit():
+            port = int(sys.argv[1])
+        else:
+            path = sys.argv[1]
+            if len(sys.argv) > 2:
+                mode = int(sys.argv[2], 8)
+    backend = DictBackend()
+    server = MemcachedServer(backend, MemcachedBinaryChannel, port=port,
+                             path=path, mode=mode, capture=capture)
+    import signal
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    signal.signal(signal.SIGUSR1, lambda *args: backend.trace.dump(sys.stderr))
+    try:
+        asyncore.loop()
+    finally:
+        if capture:
+            capture.flush()